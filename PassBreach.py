@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+离线检查密码是否在泄露密码库中（Have I Been Pwned格式的SHA-1列表，每行"SHA1:次数"）。
+先用convert()把下载的文本文件转换成排好序的定长二进制文件（每条20字节），
+之后通过mmap二分查找，不需要把几个GB的文件读进内存。可选的布隆过滤器能快速排除绝大部分未泄露的密码
+"""
+
+import os
+import sys
+import mmap
+import heapq
+import struct
+import hashlib
+import tempfile
+
+from PassDB import PassDatabase
+
+RECORD_SIZE = 20  # SHA-1摘要的长度
+BLOOM_HASHES = 7  # 布隆过滤器的哈希函数个数（每个元素置位的个数）
+BLOOM_HEADER = struct.Struct('<QQ')  # 布隆过滤器文件头：位数，对应的摘要条数
+
+
+def read_hashes(filename: str):
+    """
+    逐行读取HIBP格式的文本文件，产出SHA-1摘要（bytes）
+    """
+    with open(filename, 'r', encoding='ascii', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) >= 40:
+                yield bytes.fromhex(line[:40])
+
+
+def _bloom_positions(digest: bytes, bits: int):
+    # SHA-1本身分布均匀，直接取其中两段作为双重哈希
+    h1 = int.from_bytes(digest[0:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return ((h1 + i * h2) % bits for i in range(BLOOM_HASHES))
+
+
+def convert(src: str, dst: str, chunk_size: int = 1000000, bloom_bits_per_entry: int = 0, progress=None):
+    """
+    把文本文件转换为排好序、去掉重复的二进制文件（外部排序：分段排序后归并）
+    :param chunk_size: 每段在内存中排序的条数
+    :param bloom_bits_per_entry: 大于0时同时生成布隆过滤器dst.bloom，每条占用的位数（10位约1%误判），
+                                 否则删除以前生成的dst.bloom
+    :param progress: progress(已处理条数)
+    :return: 写入的条数
+    """
+    # 旧的过滤器与新的摘要文件不对应，留着会把泄露的密码误判为安全
+    if os.path.exists(dst + '.bloom'):
+        os.remove(dst + '.bloom')
+    runs = []
+    count = 0
+    hashes = read_hashes(src)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dst))) as folder:
+        while True:
+            chunk = [h for _, h in zip(range(chunk_size), hashes)]
+            if len(chunk) == 0:
+                break
+            chunk.sort()
+            run = os.path.join(folder, f'run{len(runs)}')
+            with open(run, 'wb') as f:
+                f.write(b''.join(chunk))
+            runs.append(run)
+            count += len(chunk)
+            if progress is not None:
+                progress(count)
+        bits = count * bloom_bits_per_entry
+        bloom = bytearray((bits + 7) // 8) if bits > 0 else None
+        files = [open(run, 'rb') for run in runs]
+        try:
+            merged = heapq.merge(*(iter(lambda f=f: f.read(RECORD_SIZE), b'') for f in files))
+            written = 0
+            last = None
+            with open(dst, 'wb') as out:
+                for digest in merged:
+                    if digest == last:
+                        continue
+                    out.write(digest)
+                    last = digest
+                    written += 1
+                    if bloom is not None:
+                        for p in _bloom_positions(digest, bits):
+                            bloom[p >> 3] |= 1 << (p & 7)
+        finally:
+            for f in files:
+                f.close()
+    if bloom is not None:
+        with open(dst + '.bloom', 'wb') as out:
+            out.write(BLOOM_HEADER.pack(bits, written))
+            out.write(bloom)
+    return written
+
+
+class BreachChecker:
+    """
+    在convert()生成的文件中查找密码
+    """
+    def __init__(self, filename: str):
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # 空文件（convert()没有写入任何摘要）不能mmap，当作什么都不包含
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self._count = size // RECORD_SIZE
+        self._bloom = None
+        self._bloom_file = None
+        if os.path.exists(filename + '.bloom'):
+            self._open_bloom(filename + '.bloom')
+
+    def _open_bloom(self, filename: str):
+        """
+        只使用与摘要文件对应的过滤器：条数不一致（例如摘要文件被重新生成）或者长度不对时忽略它
+        """
+        f = open(filename, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        if size > BLOOM_HEADER.size:
+            bits, count = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+            if bits > 0 and count == self._count and size == BLOOM_HEADER.size + (bits + 7) // 8:
+                self._bloom_file = f
+                self._bloom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._bloom_bits = bits
+                return
+        print(f'ignore mismatched bloom filter: {filename}')
+        f.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+        if self._bloom is not None:
+            self._bloom.close()
+            self._bloom_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def contains_hash(self, digest: bytes) -> bool:
+        if self._count == 0:
+            return False
+        if self._bloom is not None:
+            for p in _bloom_positions(digest, self._bloom_bits):
+                if not self._bloom[BLOOM_HEADER.size + (p >> 3)] & (1 << (p & 7)):
+                    return False
+        m = self._map
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORD_SIZE
+            value = m[offset:offset + RECORD_SIZE]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def contains(self, password: str) -> bool:
+        return self.contains_hash(hashlib.sha1(password.encode('utf-8')).digest())
+
+
+def check_vault(db: PassDatabase, checker: BreachChecker, progress=None):
+    """
+    检查数据库中所有记录的密码
+    :param progress: progress(已检查条数)，每一批调用一次
+    :return: 密码已泄露的记录的id列表
+    """
+    breached = []
+    count = 0
+    for chunk in db.select_chunks():
+        for r in chunk:
+            if r.pwd and checker.contains(r.pwd):
+                breached.append(r.sn)
+        count += len(chunk)
+        if progress is not None:
+            progress(count)
+    return breached
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'convert':
+        n = convert(sys.argv[2], sys.argv[3], bloom_bits_per_entry=10 if '--bloom' in sys.argv else 0)
+        print(f'{n} hashes are written to {sys.argv[3]}')
+    elif len(sys.argv) == 4 and sys.argv[1] == 'check':
+        with BreachChecker(sys.argv[2]) as checker:
+            vault = PassDatabase.open(sys.argv[3], 'readonly')
+            print(f'breached: {check_vault(vault, checker)}')
+    else:
+        print('usage: PassBreach.py convert <hibp.txt> <hashes.bin> [--bloom]\n'
+              '       PassBreach.py check <hashes.bin> <vault.sqlite3>')
@@ -1,8 +1,23 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
 import sqlite3
+import hashlib
+import hmac
+import json
+import re
+import time
+import queue
+import threading
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager
 
 
 class KeychainColumn(Enum):
@@ -17,17 +32,111 @@ class KeychainColumn(Enum):
     COUNT = 5
 
 
+_UNLOADED = object()  # 延迟加载的列尚未读取
+
+
+class DuplicateEntriesError(sqlite3.IntegrityError):
+    """
+    旧数据库中有重复的(loc, usr)，无法建立唯一索引，需要先删除重复的记录
+    """
+    pass
+
+
+# 连接配置：按使用场景在持久性和速度之间取舍，打开数据库时依次执行这些PRAGMA
+PROFILES = {
+    # 默认：WAL日志，每次提交都同步到磁盘
+    'durable': {'query_only': 'OFF', 'journal_mode': 'WAL', 'synchronous': 'FULL',
+                'mmap_size': 0, 'cache_size': -2000, 'temp_store': 'DEFAULT', 'busy_timeout': 5000},
+    # 断电可能丢失最近的提交，但数据库不会损坏
+    'fast': {'query_only': 'OFF', 'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+             'mmap_size': 256 << 20, 'cache_size': -16000, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+    # 只读：禁止写入，不修改日志模式
+    'readonly': {'query_only': 'ON',
+                 'mmap_size': 256 << 20, 'cache_size': -16000, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+    # 大批量导入：不等待同步，导入完成后应切换回其他配置
+    'bulk-import': {'query_only': 'OFF', 'journal_mode': 'WAL', 'synchronous': 'OFF',
+                    'mmap_size': 256 << 20, 'cache_size': -64000, 'temp_store': 'MEMORY', 'busy_timeout': 30000},
+}
+
+
+class ColumnCache:
+    """
+    延迟加载的pwd/ext列的有界缓存（LRU）
+    """
+    def __init__(self, fetch, capacity: int = 64):
+        """
+        :param fetch: fetch(sn) -> (pwd, ext)，读取失败或记录不存在时返回None
+        :param capacity: 最多缓存的记录数
+        """
+        self._fetch = fetch
+        self._capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()  # 可以被多个线程共用
+        self._generation = 0  # 每次discard()/clear()加1
+
+    def get(self, sn: int):
+        with self._lock:
+            if sn in self._items:
+                self._items.move_to_end(sn)
+                return self._items[sn]
+            generation = self._generation
+        value = self._fetch(sn)
+        if value is None:  # 失败的结果不缓存，下次重新读取
+            return None, None
+        with self._lock:
+            # 读取期间有记录被修改（写线程提交后discard），读到的可能是旧值，不能缓存
+            if generation == self._generation:
+                self._items[sn] = value
+                if len(self._items) > self._capacity:
+                    self._items.popitem(last=False)
+        return value
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def discard(self, sn: int):
+        with self._lock:
+            self._items.pop(sn, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._generation += 1
+
+
 class KeychainRecord:
     """
-    Keychain数据表的一条记录
+    Keychain数据表的一条记录。
+    使用__slots__减少每条记录的内存，未保存的列用位掩码记录：第i位对应KeychainColumn(i)
     """
+    __slots__ = ('_sn', '_loc', '_usr', '_pwd', '_ext', '_ext_type', '_cache', '_dirty')
+
     def __init__(self, location: str, username: str = None, password: str = None, extra: str = None, sn: int = 0):
         self._sn = sn
         self._loc = location
         self._usr = username
         self._pwd = password
         self._ext = extra
-        self._dirty_flags = set()
+        self._ext_type = _UNLOADED
+        self._cache = None
+        self._dirty = 0
+
+    @staticmethod
+    def lazy(sn: int, location: str, username: str, ext_type: str, cache: ColumnCache):
+        """
+        创建延迟加载的记录：pwd/ext在第一次访问时才通过cache读取
+        :param ext_type: ext中OTP的类型，没有则为None
+        """
+        record = KeychainRecord(location, username, _UNLOADED, _UNLOADED, sn)
+        record._ext_type = ext_type
+        record._cache = cache
+        return record
+
+    @property
+    def is_lazy(self):
+        return self._pwd is _UNLOADED or self._ext is _UNLOADED
 
     @property
     def sn(self):
@@ -46,7 +155,7 @@ class KeychainRecord:
         if self._loc == value:
             return
         self._loc = value
-        self._dirty_flags.add(KeychainColumn.loc)
+        self._dirty |= 1 << KeychainColumn.loc.value
 
     @property
     def usr(self):
@@ -57,106 +166,1109 @@ class KeychainRecord:
         if self._usr == value:
             return
         self._usr = value
-        self._dirty_flags.add(KeychainColumn.usr)
+        self._dirty |= 1 << KeychainColumn.usr.value
 
     @property
     def pwd(self):
+        if self._pwd is _UNLOADED:
+            return self._cache.get(self._sn)[0]
         return self._pwd
 
     @pwd.setter
     def pwd(self, value):
-        if self._pwd == value:
+        if self.pwd == value:
             return
         self._pwd = value
-        self._dirty_flags.add(KeychainColumn.pwd)
+        self._dirty |= 1 << KeychainColumn.pwd.value
 
     @property
     def ext(self):
+        if self._ext is _UNLOADED:
+            return self._cache.get(self._sn)[1]
         return self._ext
 
     @ext.setter
     def ext(self, value: str):
-        if self._ext == value:
+        if self.ext == value:
             return
         self._ext = value
-        self._dirty_flags.add(KeychainColumn.ext)
+        self._ext_type = _UNLOADED
+        self._dirty |= 1 << KeychainColumn.ext.value
+
+    @property
+    def ext_type(self):
+        """
+        ext中OTP的类型（totp/hotp），没有则为None。延迟加载的记录无需读取ext
+        """
+        if self._ext_type is _UNLOADED:
+            try:
+                self._ext_type = json.loads(self._ext)['type']
+            except Exception:
+                self._ext_type = None
+        return self._ext_type
 
     @property
     def unsaved_fields(self):
-        return self._dirty_flags
+        return set(c for c in KeychainColumn if self._dirty & (1 << c.value))
+
+    @property
+    def dirty_mask(self):
+        """
+        未保存的列的位掩码
+        """
+        return self._dirty
 
     def after_saving(self):
-        self._dirty_flags.clear()
+        self._dirty = 0
+
+
+def fold_case(text: str) -> str:
+    """
+    搜索时使用的小写形式，与re.IGNORECASE的匹配结果一致
+    """
+    return (text or '').lower()
+
+
+class _StringColumn:
+    """
+    打包存储的字符串列：所有字符串拼接成一个str，另用数组记录每条的结束位置
+    """
+    __slots__ = ('_packed', '_ends', '_pending', '_size')
+
+    def __init__(self):
+        self._packed = ''
+        self._ends = array('q')
+        self._pending = []  # 追加后尚未拼接的字符串，读取时才拼接
+        self._size = 0
+
+    def append(self, text: str):
+        text = text or ''
+        self._pending.append(text)
+        self._size += len(text)
+        self._ends.append(self._size)
+
+    @property
+    def ends(self) -> array:
+        return self._ends
+
+    @property
+    def packed(self) -> str:
+        if len(self._pending) > 0:
+            self._packed += ''.join(self._pending)
+            self._pending.clear()
+        return self._packed
+
+    def bounds(self, index: int):
+        """
+        第index条在packed中的[start, end)
+        """
+        return self._ends[index - 1] if index > 0 else 0, self._ends[index]
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self.bounds(index)
+        return self.packed[start:end]
+
+
+class RecordView:
+    """
+    RecordStore中一条记录的轻量视图，只读，用法与KeychainRecord相同
+    """
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index: int):
+        self._store = store
+        self._index = index
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def sn(self):
+        return self._store.sn(self._index)
+
+    @property
+    def loc(self):
+        return self._store.loc(self._index)
+
+    @property
+    def usr(self):
+        return self._store.usr(self._index)
+
+    @property
+    def pwd(self):
+        return self._store.columns(self._index)[0]
+
+    @property
+    def ext(self):
+        return self._store.columns(self._index)[1]
+
+    @property
+    def ext_type(self):
+        return self._store.ext_type(self._index)
+
+    def record(self) -> KeychainRecord:
+        """
+        可以修改的完整记录
+        """
+        return self._store.record(self._index)
+
+
+class RecordSnapshot:
+    """
+    RecordStore某一版本的只读副本，可以在其他线程中搜索。
+    loc/usr的打包字符串本身不可变，直接共用；下标数组只会追加，只读取创建时已有的部分
+    """
+    __slots__ = ('_version', '_ids', '_size', '_alive', '_indices', '_loc', '_usr', '_replaced')
+
+    def __init__(self, store, version: int):
+        self._version = version
+        self._ids = store._ids
+        self._size = len(store._ids)
+        self._alive = bytes(store._alive)
+        self._indices = None
+        self._loc = store._loc_folded.packed, store._loc_folded.ends
+        self._usr = store._usr_folded.packed, store._usr_folded.ends
+        self._replaced = {i: (fold_case(r.loc), fold_case(r.usr), r.pwd) for i, r in store._replaced.items()}
+
+    @property
+    def version(self):
+        return self._version
+
+    def __len__(self):
+        return self._size
+
+    def indices(self):
+        """
+        所有未被删除的记录的下标，第一次调用时计算
+        """
+        if self._indices is None:
+            alive = self._alive
+            self._indices = [i for i in range(self._size) if alive[i]]
+        return self._indices
+
+    def sn(self, index: int):
+        return self._ids[index]
+
+    def folded(self, field: str):
+        """
+        与RecordStore.folded()相同
+        """
+        packed, ends = self._loc if field == 'loc' else self._usr
+        k = 0 if field == 'loc' else 1
+        return packed, ends, {i: r[k] for i, r in self._replaced.items()}
+
+    def replaced_pwd(self, index: int):
+        """
+        :return: 被修改过的记录的pwd，没有修改过则为None
+        """
+        r = self._replaced.get(index)
+        return None if r is None else r[2]
+
+
+class RecordStore:
+    """
+    列式存储的记录集合，适合很大的数据库：
+    id存放在数组中，loc/usr打包成字符串表，OTP类型编码成一个字节，pwd/ext通过ColumnCache按需读取。
+    记录的下标在删除后保持不变，被删除的记录不再出现在遍历结果中
+    """
+    def __init__(self, cache: ColumnCache = None):
+        """
+        :param cache: 读取pwd/ext的缓存，一般是PassDatabase.column_cache
+        """
+        self._cache = cache
+        self._version = 0  # 每次修改加1，用于判断缓存的查询结果是否过期
+        self._snapshot = None
+        self.clear()
+
+    def clear(self):
+        self._ids = array('q')
+        self._loc = _StringColumn()
+        self._usr = _StringColumn()
+        self._loc_folded = _StringColumn()  # 小写的loc/usr，加载时计算一次，搜索时不再转换
+        self._usr_folded = _StringColumn()
+        self._types = array('B')
+        self._type_names = [None]  # 类型编码 -> ext_type
+        self._alive = bytearray()
+        self._count = 0
+        self._replaced = {}  # 下标 -> 修改过的KeychainRecord
+        self._sorted = True  # id是否递增，递增时可以二分查找
+        self._version += 1
+
+    def _type_code(self, ext_type: str):
+        if ext_type not in self._type_names:
+            self._type_names.append(ext_type)
+        return self._type_names.index(ext_type)
+
+    def append(self, record: KeychainRecord) -> int:
+        """
+        :return: 新记录的下标
+        """
+        index = len(self._ids)
+        if index > 0 and record.sn <= self._ids[-1]:
+            self._sorted = False
+        self._ids.append(record.sn)
+        self._loc.append(record.loc)
+        self._usr.append(record.usr)
+        self._loc_folded.append(fold_case(record.loc))
+        self._usr_folded.append(fold_case(record.usr))
+        self._types.append(self._type_code(record.ext_type))
+        self._alive.append(1)
+        self._count += 1
+        self._version += 1
+        return index
+
+    def extend(self, records):
+        for r in records:
+            self.append(r)
+
+    def replace(self, index: int, record: KeychainRecord):
+        """
+        记录被修改后用新的内容代替
+        """
+        self._replaced[index] = record
+        self._version += 1
+
+    def remove(self, index: int):
+        if self._alive[index]:
+            self._alive[index] = 0
+            self._count -= 1
+            self._replaced.pop(index, None)
+            self._version += 1
+
+    def find(self, sn: int) -> int:
+        """
+        :return: id为sn的未删除记录的下标，不存在则为-1
+        """
+        # 删除id最大的记录后SQLite会重用它的id，同一个sn可能对应一条已删除和一条未删除的记录
+        ids, alive = self._ids, self._alive
+        if self._sorted:
+            index = bisect_left(ids, sn)
+            while index < len(ids) and ids[index] == sn:
+                if alive[index]:
+                    return index
+                index += 1
+            return -1
+        index = -1
+        while True:
+            try:
+                index = ids.index(sn, index + 1)
+            except ValueError:
+                return -1
+            if alive[index]:
+                return index
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self) -> RecordSnapshot:
+        """
+        当前版本的只读副本，没有修改时返回同一个对象
+        """
+        if self._snapshot is None or self._snapshot.version != self._version:
+            self._snapshot = RecordSnapshot(self, self._version)
+        return self._snapshot
+
+    def is_alive(self, index: int) -> bool:
+        return 0 <= index < len(self._alive) and self._alive[index] == 1
+
+    def __iter__(self):
+        for i, alive in enumerate(self._alive):
+            if alive:
+                yield RecordView(self, i)
+
+    def indices(self):
+        """
+        所有未被删除的记录的下标
+        """
+        alive = self._alive
+        return [i for i in range(len(alive)) if alive[i]]
+
+    def view(self, index: int) -> RecordView:
+        return RecordView(self, index)
+
+    # 按下标读取各列
+
+    def sn(self, index: int):
+        return self._ids[index]
+
+    def loc(self, index: int):
+        if index in self._replaced:
+            return self._replaced[index].loc
+        return self._loc[index]
+
+    def usr(self, index: int):
+        if index in self._replaced:
+            return self._replaced[index].usr
+        return self._usr[index]
+
+    def ext_type(self, index: int):
+        if index in self._replaced:
+            return self._replaced[index].ext_type
+        return self._type_names[self._types[index]]
+
+    def columns(self, index: int):
+        """
+        :return: (pwd, ext)
+        """
+        if index in self._replaced:
+            r = self._replaced[index]
+            return r.pwd, r.ext
+        if self._cache is None:
+            return None, None
+        return self._cache.get(self._ids[index])
+
+    def folded(self, field: str):
+        """
+        小写形式的loc或usr列，供搜索使用
+        :param field: 'loc'或'usr'
+        :return: (打包的字符串, 每条的结束位置, {下标: 被修改过的记录的小写内容})
+        """
+        column = self._loc_folded if field == 'loc' else self._usr_folded
+        overrides = {i: fold_case(getattr(r, field)) for i, r in self._replaced.items()}
+        return column.packed, column.ends, overrides
+
+    def record(self, index: int) -> KeychainRecord:
+        if index in self._replaced:
+            return self._replaced[index]
+        return KeychainRecord.lazy(self._ids[index], self._loc[index], self._usr[index], self.ext_type(index), self._cache)
 
 
 class PassDatabase:
     """
     密码数据库
     """
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, profile: str = 'durable', check_same_thread: bool = True, migrate: bool = True):
+        """
+        :param profile: 连接配置，见PROFILES
+        :param check_same_thread: 为False时允许在创建连接以外的线程中使用（由调用者保证不并发）
+        :param migrate: 是否把数据库升级到最新版本（只读配置不升级）
+        """
         self._filename = filename
-        self._con = sqlite3.connect(filename)
+        self._con = sqlite3.connect(filename, check_same_thread=check_same_thread)
+        self._tx_depth = 0  # 当前事务的嵌套层数
+        self._cache = ColumnCache(self.fetch_columns)  # 延迟加载记录共用
+        self._profile = None
+        self._hash_key = None  # pwd_hash的密钥，第一次使用时读取
+        self.set_profile(profile)
+        if migrate and profile != 'readonly':
+            try:
+                self.migrate()
+            except DuplicateEntriesError:
+                self._con.close()
+                raise
+
+    def set_profile(self, profile: str):
+        """
+        切换连接配置。journal_mode不能在事务中修改
+        """
+        if profile not in PROFILES:
+            raise ValueError(f'unknown profile: {profile}')
+        for name, value in PROFILES[profile].items():
+            self._con.execute(f'PRAGMA {name}={value}').fetchall()
+        self._profile = profile
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @property
+    def column_cache(self):
+        return self._cache
+
+    def set_deadline(self, deadline: float = None):
+        """
+        查询执行到deadline（time.perf_counter()的时刻）时中断，None表示不限
+        """
+        if deadline is None:
+            self._con.set_progress_handler(None, 0)
+        else:
+            self._con.set_progress_handler(lambda: time.perf_counter() > deadline, 1000)
 
     def close(self):
+        self._cache.clear()
         self._con.close()
         self._filename = None
 
     def select_all(self):
         records = []
+        for chunk in self.select_chunks():
+            records.extend(chunk)
+        return records
+
+    # 延迟加载时读取的列：ext只取出OTP类型
+    _LAZY_COLUMNS = "id,loc,usr,CASE WHEN json_valid(ext) THEN json_extract(ext,'$.type') END"
+
+    def _to_records(self, rows, lazy: bool):
+        if lazy:
+            return [KeychainRecord.lazy(s, l, u, t, self._cache) for s, l, u, t in rows]
+        return [KeychainRecord(l, u, p, e, s) for s, l, u, p, e in rows]
+
+    def select_chunks(self, chunk_size: int = 1000, lazy: bool = False, after: int = 0, raise_errors: bool = False):
+        """
+        分批读取所有记录（按id排序），每次产出一个KeychainRecord列表
+        :param chunk_size: 每次fetchmany读取的行数
+        :param lazy: 只读取id,loc,usr和OTP类型，pwd/ext在使用时才读取
+        :param after: 只读取id大于after的记录
+        :param raise_errors: 读取出错时抛出异常。默认只打印错误并停止产出，调用者无法区分出错和读完
+        """
         try:
-            sql = 'SELECT id,loc,usr,pwd,ext FROM keychain'
+            columns = PassDatabase._LAZY_COLUMNS if lazy else 'id,loc,usr,pwd,ext'
             cur = self._con.cursor()
-            cur.execute(sql)
-            for s, l, u, p, e in cur.fetchall():
-                records.append(KeychainRecord(l, u, p, e, s))
+            cur.execute(f'SELECT {columns} FROM keychain WHERE id>? ORDER BY id', (after,))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                yield self._to_records(rows, lazy)
         except Exception as ex:
             print(f'Error on reading: {ex}')
-        finally:
-            return records
+            if raise_errors:
+                raise
+
+    def select_page(self, after: int = 0, limit: int = 1000, lazy: bool = False):
+        """
+        读取id大于after的一页记录（按id排序）。每页是一次独立的查询，不占用游标
+        :param after: 上一页最后一条记录的id
+        :return: KeychainRecord列表，为空表示已经读完
+        """
+        records = []
+        try:
+            columns = PassDatabase._LAZY_COLUMNS if lazy else 'id,loc,usr,pwd,ext'
+            cur = self._con.execute(f'SELECT {columns} FROM keychain WHERE id>? ORDER BY id LIMIT ?', (after, limit))
+            records = self._to_records(cur.fetchall(), lazy)
+        except Exception as ex:
+            print(f'Error on reading: {ex}')
+        return records
+
+    def select_iter(self, chunk_size: int = 1000, lazy: bool = False):
+        """
+        逐条产出所有记录，内存中最多只保留一批
+        """
+        for chunk in self.select_chunks(chunk_size, lazy):
+            yield from chunk
+
+    def fetch_columns(self, sn: int):
+        """
+        读取一条记录的pwd/ext列，供延迟加载的记录使用
+        :return: (pwd, ext)，出错或记录不存在时为None
+        """
+        try:
+            cur = self._con.execute('SELECT pwd,ext FROM keychain WHERE id=?', (sn,))
+            return cur.fetchone()
+        except Exception as e:
+            print(f'Error on reading: {e}')
+        return None
+
+    def search(self, loc: str = None, usr: str = None, limit: int = -1):
+        """
+        在SQLite中按location/username做子串搜索（不区分大小写），结果按id排序
+        :param loc: location中包含的文字，为空则不限
+        :param usr: username中包含的文字，为空则不限
+        :param limit: 最多返回的条数，负数表示不限
+        :return: KeychainRecord列表
+        """
+        records = []
+        matches = []
+        likes = []
+        args = []
+        for col, text in (('loc', loc), ('usr', usr)):
+            if not text:
+                continue
+            if len(text) >= 3:  # trigram分词器至少需要3个字符
+                matches.append('%s : "%s"' % (col, text.replace('"', '""')))
+            else:
+                likes.append(f"f.{col} LIKE ? ESCAPE '\\'")
+                args.append('%%%s%%' % re.sub(r'([%_\\])', r'\\\1', text))
+        try:
+            if len(matches) + len(likes) == 0:
+                sql = 'SELECT id,loc,usr,pwd,ext FROM keychain ORDER BY id LIMIT ?'
+            else:
+                conds = likes
+                if len(matches) > 0:
+                    conds.insert(0, 'keychain_fts MATCH ?')
+                    args.insert(0, ' AND '.join(matches))
+                sql = ('SELECT k.id,k.loc,k.usr,k.pwd,k.ext FROM keychain_fts f JOIN keychain k ON k.id=f.rowid '
+                       'WHERE %s ORDER BY f.rowid LIMIT ?' % ' AND '.join(conds))
+            args.append(limit)
+            cur = self._con.execute(sql, args)
+            records = [KeychainRecord(l, u, p, e, s) for s, l, u, p, e in cur.fetchall()]
+        except Exception as e:
+            print(f'Error on searching: {e}')
+        return records
+
+    @contextmanager
+    def transaction(self):
+        """
+        事务范围：范围内的所有写操作推迟到退出时一次性提交，出错则全部回滚。
+        嵌套使用时，内层范围对应一个SAVEPOINT
+        """
+        depth = self._tx_depth
+        generation = self._cache.generation
+        if depth == 0:
+            self._con.execute('BEGIN IMMEDIATE')
+        else:
+            self._con.execute(f'SAVEPOINT sp{depth}')
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if depth == 0:
+                self._con.rollback()
+            else:
+                self._con.execute(f'ROLLBACK TO sp{depth}')
+                self._con.execute(f'RELEASE sp{depth}')
+            raise
+        self._tx_depth -= 1
+        if depth == 0:
+            self._con.commit()
+            # 范围内的discard()早于提交，其他线程在这期间可能又缓存了旧值
+            if self._cache.generation != generation:
+                self._cache.clear()
+        else:
+            self._con.execute(f'RELEASE sp{depth}')
+
+    @property
+    def in_transaction(self):
+        return self._tx_depth > 0
 
     def insert(self, record: KeychainRecord):
         try:
             sql = 'INSERT INTO keychain (loc, usr, pwd, ext) VALUES(?,?,?,?)'
             args = (record.loc, record.usr, record.pwd, record.ext)
-            cur = self._con.cursor()
-            cur.execute(sql, args)
-            self._con.commit()
+            with self.transaction():
+                cur = self._con.cursor()
+                cur.execute(sql, args)
             record.sn = cur.lastrowid
             record.after_saving()
         except Exception as e:
             print(f'Error on insertion: {e}')
+            if self.in_transaction:  # 让外层事务整体回滚
+                raise
+
+    def insert_or_ignore(self, record: KeychainRecord):
+        """
+        插入一条记录，如果(loc, usr)已经存在则忽略
+        :return: 是否插入成功
+        """
+        try:
+            sql = 'INSERT INTO keychain (loc, usr, pwd, ext) VALUES(?,?,?,?) ON CONFLICT(loc, usr) DO NOTHING'
+            args = (record.loc, record.usr, record.pwd, record.ext)
+            with self.transaction():
+                cur = self._con.cursor()
+                cur.execute(sql, args)
+            if cur.rowcount == 0:
+                return False
+            record.sn = cur.lastrowid
+            record.after_saving()
+            return True
+        except Exception as e:
+            print(f'Error on insertion: {e}')
+            if self.in_transaction:
+                raise
+            return False
+
+    def upsert(self, record: KeychainRecord):
+        """
+        插入一条记录，如果(loc, usr)已经存在则更新其pwd和ext
+        """
+        try:
+            sql = ('INSERT INTO keychain (loc, usr, pwd, ext) VALUES(?,?,?,?) '
+                   'ON CONFLICT(loc, usr) DO UPDATE SET pwd=excluded.pwd, ext=excluded.ext RETURNING id')
+            args = (record.loc, record.usr, record.pwd, record.ext)
+            with self.transaction():
+                record.sn = self._con.execute(sql, args).fetchone()[0]
+            self._cache.discard(record.sn)
+            record.after_saving()
+        except Exception as e:
+            print(f'Error on insertion: {e}')
+            if self.in_transaction:
+                raise
+
+    def exists(self, loc: str, usr: str):
+        """
+        (loc, usr)是否已经存在，走唯一索引
+        """
+        try:
+            cur = self._con.execute('SELECT 1 FROM keychain WHERE loc=? AND usr=? LIMIT 1', (loc, usr))
+            return cur.fetchone() is not None
+        except Exception as e:
+            print(f'Error on reading: {e}')
+            return False
+
+    def insert_many(self, records, chunk_size: int = 500, ignore_duplicates: bool = False):
+        """
+        批量插入记录，所有记录在同一个事务中提交
+        :param records: KeychainRecord的任意可迭代对象（可以是生成器）
+        :param chunk_size: 每次executemany处理的记录数
+        :param ignore_duplicates: 跳过(loc, usr)已经存在的记录，被跳过的记录sn为0
+        :return: 插入的记录数
+        """
+        saved = []  # (记录, id)，事务提交后才写回记录，失败时记录保持原样
+        try:
+            sql = 'INSERT INTO keychain (id, loc, usr, pwd, ext) VALUES(?,?,?,?,?)'
+            if ignore_duplicates:
+                sql += ' ON CONFLICT(loc, usr) DO NOTHING'
+            with self.transaction():
+                cur = self._con.cursor()
+                # executemany不会返回每一行的lastrowid，所以在事务内预先分配id
+                cur.execute('SELECT COALESCE(MAX(id), 0) FROM keychain')
+                next_id = cur.fetchone()[0] + 1
+                it = iter(records)
+                while True:
+                    chunk = list(islice(it, chunk_size))
+                    if len(chunk) == 0:
+                        break
+                    args = ((next_id + i, r.loc, r.usr, r.pwd, r.ext) for i, r in enumerate(chunk))
+                    cur.executemany(sql, args)
+                    if ignore_duplicates:  # 找出这一批中真正插入的id
+                        cur.execute('SELECT id FROM keychain WHERE id BETWEEN ? AND ?',
+                                    (next_id, next_id + len(chunk) - 1))
+                        inserted = set(i for i, in cur.fetchall())
+                    for r in chunk:
+                        saved.append((r, 0 if ignore_duplicates and next_id not in inserted else next_id))
+                        next_id += 1
+        except Exception as e:
+            print(f'Error on insertion: {e}')
+            if self.in_transaction:
+                raise
+            return 0
+        count = 0
+        for r, sn in saved:
+            r.sn = sn
+            if sn != 0:
+                r.after_saving()
+                count += 1
+        return count
+
+    _UPDATE_SQL = {}  # 需要保存的列的位掩码 -> UPDATE语句
+
+    @staticmethod
+    def _update_statement(mask: int):
+        """
+        同样的列组合总是得到同一条SQL，sqlite3模块会复用已编译的语句
+        """
+        sql = PassDatabase._UPDATE_SQL.get(mask)
+        if sql is None:
+            names = [c.name for c in KeychainColumn if mask & (1 << c.value)]
+            sql = 'UPDATE keychain SET %s WHERE id=:id' % ', '.join(f'{n}=:{n}' for n in names)
+            PassDatabase._UPDATE_SQL[mask] = sql
+        return sql
+
+    @staticmethod
+    def _update_args(record: KeychainRecord):
+        args = {c.name: getattr(record, c.name) for c in record.unsaved_fields}
+        args['id'] = record.sn
+        return args
 
     def update(self, record: KeychainRecord):
-        args = {}
-        cols = []
-        for i in record.unsaved_fields:
-            if i == KeychainColumn.loc:
-                args['loc'] = record.loc
-                cols.append('loc=:loc')
-            elif i == KeychainColumn.usr:
-                args['usr'] = record.usr
-                cols.append('usr=:usr')
-            elif i == KeychainColumn.pwd:
-                args['pwd'] = record.pwd
-                cols.append('pwd=:pwd')
-            elif i == KeychainColumn.ext:
-                args['ext'] = record.ext
-                cols.append('ext=:ext')
-        try:
-            if len(cols) > 0:
-                sql = 'UPDATE keychain SET %s WHERE id=%d' % (', '.join(cols), record.sn)
-                self._con.execute(sql, args)
-                self._con.commit()
+        """
+        :return: 是否保存成功（没有需要保存的修改也算成功）
+        """
+        mask = record.dirty_mask
+        try:
+            if mask != 0:
+                sql = PassDatabase._update_statement(mask)
+                with self.transaction():
+                    self._con.execute(sql, PassDatabase._update_args(record))
+                self._cache.discard(record.sn)
                 record.after_saving()
+            return True
         except Exception as e:
             print(f'Error on update: {e}')
+            if self.in_transaction:
+                raise
+            return False
+
+    def update_many(self, records):
+        """
+        批量保存记录的修改：按需要保存的列的组合分组，每组用一条语句executemany，
+        所有记录在同一个事务中提交
+        :return: 保存的记录数
+        """
+        groups = {}
+        for r in records:
+            if r.dirty_mask != 0:
+                groups.setdefault(r.dirty_mask, []).append(r)
+        count = 0
+        try:
+            with self.transaction():
+                for mask, group in groups.items():
+                    sql = PassDatabase._update_statement(mask)
+                    self._con.executemany(sql, (PassDatabase._update_args(r) for r in group))
+            for group in groups.values():
+                for r in group:
+                    self._cache.discard(r.sn)
+                    r.after_saving()
+                count += len(group)
+        except Exception as e:
+            print(f'Error on update: {e}')
+            if self.in_transaction:
+                raise
+            return 0
+        return count
 
     def delete(self, sn):
         try:
-            self._con.execute('DELETE FROM keychain WHERE id=?', (sn,))
-            self._con.commit()
+            with self.transaction():
+                self._con.execute('DELETE FROM keychain WHERE id=?', (sn,))
+            self._cache.discard(sn)
+        except Exception as e:
+            print(f'Error on deletion: {e}')
+            if self.in_transaction:
+                raise
+
+    def backup(self, dest: str, pages_per_step: int = 256, sleep: float = 0.005, progress=None, keep: int = 0):
+        """
+        在线备份：每次复制pages_per_step页，中间休息sleep秒，不会长时间阻塞其他读写。
+        使用独立的连接，可以在后台线程中调用
+        :param progress: progress(status, remaining, total)，每复制一步调用一次
+        :param keep: 大于0时保留之前的备份：dest.1（最新）... dest.keep
+        :return: 是否成功
+        """
+        tmp = dest + '.tmp'
+        try:
+            src = sqlite3.connect(self._filename)
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst, pages=pages_per_step, progress=progress, sleep=sleep)
+            finally:
+                dst.close()
+                src.close()
+            if keep > 0 and os.path.exists(dest):
+                for i in range(keep - 1, 0, -1):
+                    if os.path.exists(f'{dest}.{i}'):
+                        os.replace(f'{dest}.{i}', f'{dest}.{i + 1}')
+                os.replace(dest, f'{dest}.1')
+            os.replace(tmp, dest)  # 备份完成才替换，不会留下不完整的文件
+            return True
+        except Exception as e:
+            print(f'Error on backup of DB: {e}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+
+    def data_version(self):
+        """
+        PRAGMA data_version：其他连接提交修改后该值会变化，本连接自己的修改不会改变它
+        """
+        try:
+            return self._con.execute('PRAGMA data_version').fetchone()[0]
+        except Exception as e:
+            print(f'Error on reading: {e}')
+            return None
+
+    def last_change(self):
+        """
+        :return: 修改日志中最新的序号，没有则为0
+        """
+        try:
+            # sqlite_sequence记录AUTOINCREMENT分配过的最大序号，日志被清理后也不会变小
+            sql = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='keychain_log'), 0)"
+            return self._con.execute(sql).fetchone()[0]
+        except Exception as e:
+            print(f'Error on reading: {e}')
+            return 0
+
+    def changes_since(self, seq: int, lazy: bool = True):
+        """
+        读取序号seq之后的修改，同一条记录的多次修改合并为最终结果
+        :return: (最新序号, 新增或修改过的KeychainRecord列表, 已删除的id列表)。
+                 seq之后的日志已经被其他程序清理掉时，两个列表都为None，调用者需要重新加载所有记录
+        """
+        last = seq
+        changed = []
+        deleted = []
+        try:
+            latest = self.last_change()
+            first = self._con.execute('SELECT MIN(seq) FROM keychain_log').fetchone()[0]
+            if latest > seq and (first is None or first > seq + 1):
+                return latest, None, None
+            sql = 'SELECT id, MAX(seq) FROM keychain_log WHERE seq>? GROUP BY id'
+            ids = []
+            for sn, s in self._con.execute(sql, (seq,)).fetchall():
+                ids.append(sn)
+                last = max(last, s)
+            columns = PassDatabase._LAZY_COLUMNS if lazy else 'id,loc,usr,pwd,ext'
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                sql = 'SELECT %s FROM keychain WHERE id IN (%s)' % (columns, ','.join('?' * len(batch)))
+                changed.extend(self._to_records(self._con.execute(sql, batch).fetchall(), lazy))
+            existing = set(r.sn for r in changed)
+            deleted = [sn for sn in ids if sn not in existing]  # 最后一次操作是删除
+            for sn in ids:
+                self._cache.discard(sn)
+        except Exception as e:
+            print(f'Error on reading: {e}')
+            return seq, [], []
+        return last, changed, deleted
+
+    # 修改日志的保留策略：已经应用的日志在trim_changes()时删除，但始终保留最近LOG_KEEP条，
+    # 供同时打开同一数据库的其他程序读取。落后超过LOG_KEEP条的程序由changes_since()发现，需要重新加载
+    LOG_KEEP = 1000
+
+    def trim_changes(self, seq: int, keep: int = LOG_KEEP):
+        """
+        删除序号seq及之前的修改日志，最近keep条除外
+        """
+        try:
+            with self.transaction():
+                self._con.execute('DELETE FROM keychain_log WHERE seq<=? AND '
+                                  'seq<=(SELECT COALESCE(MAX(seq), 0) FROM keychain_log)-?', (seq, keep))
         except Exception as e:
             print(f'Error on deletion: {e}')
+            if self.in_transaction:
+                raise
+
+    def _pwd_hash(self, pwd: str):
+        if self._hash_key is None:
+            cur = self._con.execute("SELECT value FROM keychain_meta WHERE name='pwd_hash_key'")
+            self._hash_key = cur.fetchone()[0]
+        return hmac.digest(self._hash_key, pwd.encode('utf-8'), 'sha256')[:16]
+
+    def refresh_pwd_hashes(self, batch_size: int = 1000):
+        """
+        为pwd_hash为空的记录（新增或修改过密码的）计算哈希，每批单独提交
+        :return: 计算的条数
+        """
+        count = 0
+        try:
+            sql = ("SELECT id, pwd FROM keychain WHERE pwd_hash IS NULL AND pwd IS NOT NULL AND pwd!='' "
+                   "AND id>? ORDER BY id LIMIT ?")
+            after = 0
+            while True:
+                rows = self._con.execute(sql, (after, batch_size)).fetchall()
+                if len(rows) == 0:
+                    break
+                with self.transaction():
+                    self._con.executemany('UPDATE keychain SET pwd_hash=? WHERE id=?',
+                                          ((self._pwd_hash(p), i) for i, p in rows))
+                count += len(rows)
+                after = rows[-1][0]
+        except Exception as e:
+            print(f'Error on update: {e}')
+            if self.in_transaction:
+                raise
+        return count
+
+    def reused_passwords(self, min_count: int = 2):
+        """
+        查找被多条记录使用的密码，只比较哈希，不读取密码本身
+        :return: id列表的列表，使用次数多的在前
+        """
+        groups = []
+        try:
+            self.refresh_pwd_hashes()
+            sql = ('SELECT group_concat(id) FROM keychain WHERE pwd_hash IS NOT NULL '
+                   'GROUP BY pwd_hash HAVING COUNT(*)>=?')
+            groups = [[int(i) for i in ids.split(',')] for ids, in self._con.execute(sql, (min_count,))]
+            groups.sort(key=len, reverse=True)
+        except Exception as e:
+            print(f'Error on reading: {e}')
+        return groups
+
+    def same_password(self, sn: int):
+        """
+        :return: 与记录sn使用相同密码的其他记录的id列表
+        """
+        try:
+            self.refresh_pwd_hashes()
+            sql = ('SELECT k.id FROM keychain k JOIN keychain s ON k.pwd_hash=s.pwd_hash '
+                   'WHERE s.id=? AND k.id!=s.id ORDER BY k.id')
+            return [i for i, in self._con.execute(sql, (sn,))]
+        except Exception as e:
+            print(f'Error on reading: {e}')
+            return []
+
+    # 本程序的数据库在文件头中的标记（PRAGMA application_id），值为'PSTR'
+    APPLICATION_ID = 0x50535452
+    # 数据库结构的版本（PRAGMA user_version），每个版本对应_MIGRATIONS中的一步
+    SCHEMA_VERSION = 4
+    # keychain表各列（名称 类型）的指纹，用于识别没有application_id的旧数据库
+    KEYCHAIN_FINGERPRINT = hashlib.sha1(b'id INTEGER,loc TEXT,usr TEXT,pwd TEXT,ext TEXT').hexdigest()
+
+    @staticmethod
+    def has_sqlite_header(filename: str):
+        """
+        只读取文件头，判断是否是SQLite数据库
+        """
+        try:
+            with open(filename, 'rb') as f:
+                return f.read(16) == b'SQLite format 3\x00'
+        except OSError:
+            return False
+
+    def schema_fingerprint(self):
+        cur = self._con.execute('PRAGMA table_info (keychain)')
+        columns = cur.fetchall()[:KeychainColumn.COUNT.value]
+        text = ','.join(f'{c[1]} {c[2].upper()}' for c in columns)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def check_schema(self):
+        """
+        校验本连接打开的是否是本程序的数据库：有标记的只比较版本号，旧数据库比较keychain表的结构指纹
+        """
+        try:
+            app_id = self._con.execute('PRAGMA application_id').fetchone()[0]
+            if app_id == PassDatabase.APPLICATION_ID:
+                return self.schema_version <= PassDatabase.SCHEMA_VERSION
+            return app_id == 0 and self.schema_fingerprint() == PassDatabase.KEYCHAIN_FINGERPRINT
+        except Exception as e:
+            print(f'Error on validation of DB: {e}')
+            return False
+
+    @property
+    def schema_version(self):
+        return self._con.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, batch_size: int = 5000):
+        """
+        把数据库逐个版本升级到SCHEMA_VERSION。每个版本的升级完成后才记录版本号，
+        中途失败的话下次打开时从该版本重新开始。有重复记录时抛出DuplicateEntriesError
+        :param batch_size: 需要回填数据时每批处理的行数，每批单独提交
+        """
+        current = self.schema_version
+        for version, step in PassDatabase._MIGRATIONS:
+            if version <= current:
+                continue
+            try:
+                step(self, batch_size)
+                with self.transaction():
+                    self._con.execute(f'PRAGMA user_version={version}')
+                    self._con.execute(f'PRAGMA application_id={PassDatabase.APPLICATION_ID}')
+            except DuplicateEntriesError:
+                raise
+            except Exception as e:
+                if self._con.in_transaction:
+                    self._con.rollback()
+                print(f'Error on upgrade of DB (version {version}): {e}')
+                break
+
+    def _backfill(self, sql: str, batch_size: int):
+        """
+        按id分批执行sql（参数是id的范围(start, end]），每批单独提交
+        """
+        last = self._con.execute('SELECT COALESCE(MAX(id), 0) FROM keychain').fetchone()[0]
+        start = 0
+        while start < last:
+            with self.transaction():
+                self._con.execute(sql, (start, min(start + batch_size, last)))
+            start += batch_size
+
+    def _migrate_search(self, batch_size: int):
+        """
+        版本1：loc/usr的FTS5全文索引（trigram分词），由触发器保持同步
+        """
+        with self.transaction():
+            self._con.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS keychain_fts USING fts5(
+                        loc, usr, content='keychain', content_rowid='id', tokenize='trigram')''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_fts_ai AFTER INSERT ON keychain BEGIN
+                INSERT INTO keychain_fts(rowid, loc, usr) VALUES (new.id, new.loc, new.usr);
+            END''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_fts_ad AFTER DELETE ON keychain BEGIN
+                INSERT INTO keychain_fts(keychain_fts, rowid, loc, usr) VALUES ('delete', old.id, old.loc, old.usr);
+            END''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_fts_au AFTER UPDATE OF loc, usr ON keychain BEGIN
+                INSERT INTO keychain_fts(keychain_fts, rowid, loc, usr) VALUES ('delete', old.id, old.loc, old.usr);
+                INSERT INTO keychain_fts(rowid, loc, usr) VALUES (new.id, new.loc, new.usr);
+            END''')
+            self._con.execute("INSERT INTO keychain_fts(keychain_fts) VALUES ('delete-all')")
+        # 已有的记录分批加入索引，之后新增的记录由触发器处理
+        self._backfill('INSERT INTO keychain_fts(rowid, loc, usr) '
+                       'SELECT id, loc, usr FROM keychain WHERE id>? AND id<=?', batch_size)
+
+    def _migrate_unique(self, batch_size: int):
+        """
+        版本2：(loc, usr)唯一索引，插入和导入都依赖它。
+        已有重复记录时无法建立，抛出DuplicateEntriesError，版本号停留在1，删除重复记录后下次打开时重试
+        """
+        try:
+            with self.transaction():
+                self._con.execute('CREATE UNIQUE INDEX IF NOT EXISTS keychain_loc_usr ON keychain (loc, usr)')
+        except sqlite3.IntegrityError:
+            rows = self._con.execute('SELECT loc, usr, COUNT(*) FROM keychain GROUP BY loc, usr '
+                                     'HAVING COUNT(*) > 1 LIMIT 5').fetchall()
+            names = '\n'.join(f'{loc} ({usr}) x{n}' for loc, usr, n in rows)
+            raise DuplicateEntriesError(f'Duplicated location and username, please remove them first:\n{names}')
+
+    def _migrate_changelog(self, batch_size: int):
+        """
+        版本3：修改日志，每次增删改都记一笔，op: I(insert) U(update) D(delete)
+        """
+        with self.transaction():
+            self._con.execute('''CREATE TABLE IF NOT EXISTS keychain_log (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id  INTEGER NOT NULL,
+                        op  TEXT NOT NULL)''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_log_ai AFTER INSERT ON keychain BEGIN
+                INSERT INTO keychain_log(id, op) VALUES (new.id, 'I');
+            END''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_log_au AFTER UPDATE OF loc, usr, pwd, ext ON keychain BEGIN
+                INSERT INTO keychain_log(id, op) VALUES (new.id, 'U');
+            END''')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_log_ad AFTER DELETE ON keychain BEGIN
+                INSERT INTO keychain_log(id, op) VALUES (old.id, 'D');
+            END''')
+
+    def _migrate_pwd_hash(self, batch_size: int):
+        """
+        版本4：密码的带密钥哈希（pwd_hash列，有索引），用于查找重复使用的密码。
+        密码修改时触发器把哈希清空，由refresh_pwd_hashes()补算
+        """
+        with self.transaction():
+            self._con.execute('CREATE TABLE IF NOT EXISTS keychain_meta (name TEXT PRIMARY KEY, value BLOB)')
+            self._con.execute("INSERT OR IGNORE INTO keychain_meta (name, value) VALUES ('pwd_hash_key', ?)",
+                              (os.urandom(32),))
+            columns = [c[1] for c in self._con.execute('PRAGMA table_info (keychain)').fetchall()]
+            if 'pwd_hash' not in columns:
+                self._con.execute('ALTER TABLE keychain ADD COLUMN pwd_hash BLOB')
+            self._con.execute('CREATE INDEX IF NOT EXISTS keychain_pwd_hash ON keychain (pwd_hash)')
+            self._con.execute('''CREATE TRIGGER IF NOT EXISTS keychain_pwd_au AFTER UPDATE OF pwd ON keychain BEGIN
+                UPDATE keychain SET pwd_hash=NULL WHERE id=new.id;
+            END''')
+        self.refresh_pwd_hashes(batch_size)
+
+    # (版本号, 升级到该版本的方法)
+    _MIGRATIONS = ((1, _migrate_search),
+                   (2, _migrate_unique),
+                   (3, _migrate_changelog),
+                   (4, _migrate_pwd_hash))
+
+    @staticmethod
+    def open(filename: str, profile: str = 'durable'):
+        """
+        打开并校验数据库，需要时升级到最新版本。校验和使用共用同一个连接
+        :return: PassDatabase，不是本程序的数据库时为None
+        :raise DuplicateEntriesError: 旧数据库中有重复的(loc, usr)，无法升级
+        """
+        if not PassDatabase.has_sqlite_header(filename):
+            return None
+        # 先用只读配置校验，不是本程序的数据库时不能修改它（例如切换到WAL模式）
+        try:
+            db = PassDatabase(filename, 'readonly', migrate=False)
+        except sqlite3.DatabaseError as e:
+            print(f'Error on validation of DB: {e}')
+            return None
+        if not db.check_schema():
+            db.close()
+            return None
+        if profile != 'readonly':
+            try:
+                db.set_profile(profile)
+                db.migrate()
+            except DuplicateEntriesError:
+                db.close()
+                raise
+            except sqlite3.Error as e:
+                print(f'Error on opening of DB: {e}')
+                db.close()
+                return None
+        return db
 
     @staticmethod
     def create_db(filename: str):
@@ -170,6 +1282,7 @@ class PassDatabase:
             con = sqlite3.connect(filename)
             con.executescript(sql)
             con.commit()
+            con.close()
             #
             return PassDatabase(filename)
         except Exception as e:
@@ -183,23 +1296,356 @@ class PassDatabase:
         :param filename:
         :return:
         """
-        def is_column_identical(cursor, table_name: str, table_columns):
-            cursor.execute(f'PRAGMA table_info ({table_name})')
-            structs = cursor.fetchall()
-            result = (structs[i][1] == table_columns[i] for i in range(len(table_columns)))
-            return all(result)
-        is_valid = False
+        db = PassDatabase.open(filename, 'readonly')
+        if db is None:
+            return False
+        db.close()
+        return True
+
+    @property
+    def source(self):
+        return self._filename
+
+
+class VaultFederation:
+    """
+    同时搜索多个数据库文件。同时打开的连接数有上限，超过时关闭最久未使用的（LRU）
+    """
+    def __init__(self, filenames=(), max_open: int = 8, profile: str = 'durable'):
+        self._filenames = []
+        self._max_open = max_open
+        self._profile = profile
+        self._open = OrderedDict()  # filename -> PassDatabase
+        self._invalid = set()  # 无法打开或不是本程序数据库的文件，搜索时跳过
+        for f in filenames:
+            self.add(f)
+
+    def add(self, filename: str):
+        if filename not in self._filenames:
+            self._filenames.append(filename)
+
+    def remove(self, filename: str):
+        if filename in self._filenames:
+            self._filenames.remove(filename)
+        self._invalid.discard(filename)
+        db = self._open.pop(filename, None)
+        if db is not None:
+            db.close()
+
+    @property
+    def sources(self):
+        return list(self._filenames)
+
+    @property
+    def invalid(self):
+        """
+        校验失败、被跳过的文件
+        """
+        return [f for f in self._filenames if f in self._invalid]
+
+    def database(self, filename: str) -> PassDatabase:
+        """
+        取得某个数据库的连接，需要时打开，并关闭最久未使用的连接
+        :return: PassDatabase，文件不存在或不是本程序的数据库时为None
+        """
+        db = self._open.get(filename)
+        if db is not None:
+            self._open.move_to_end(filename)
+            return db
+        if filename in self._invalid:
+            return None
         try:
-            with sqlite3.connect(filename) as con:
-                cur = con.cursor()
-                tables = {'keychain': [KeychainColumn(i).name for i in range(KeychainColumn.COUNT.value)]}
-                is_valid = all(is_column_identical(cur, i, j) for i, j in tables.items())
-        except Exception as e:
-            print(f'Error on validation of DB: {e}')
+            db = PassDatabase.open(filename, self._profile)
+            if db is None:
+                print(f'Skip {filename}: not a valid database')
+        except DuplicateEntriesError as e:
+            print(f'Skip {filename}: {e}')
+            db = None
+        if db is None:
+            self._invalid.add(filename)
+            return None
+        self._open[filename] = db
+        if len(self._open) > self._max_open:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+        return db
+
+    def search(self, loc: str = None, usr: str = None, limit: int = -1, budget: float = None):
+        """
+        依次搜索所有数据库，结果标明来源
+        :param limit: 所有数据库合计最多返回的条数，负数表示不限
+        :param budget: 时间预算（秒），超时后正在执行的查询被中断，剩余的数据库不再搜索
+        :return: [(filename, KeychainRecord)]
+        """
+        deadline = None if budget is None else time.perf_counter() + budget
+        hits = []
+        for filename in self._filenames:
+            remains = -1 if limit < 0 else limit - len(hits)
+            if remains == 0 or (deadline is not None and time.perf_counter() > deadline):
+                break
+            db = self.database(filename)
+            if db is None:
+                continue
+            db.set_deadline(deadline)
+            try:
+                hits.extend((filename, r) for r in db.search(loc, usr, remains))
+            finally:
+                db.set_deadline(None)
+        return hits
+
+    def close(self):
+        for db in self._open.values():
+            db.close()
+        self._open.clear()
+
+
+class PooledPassDatabase:
+    """
+    线程安全的密码数据库：每个线程使用自己的只读连接（WAL模式下读写互不阻塞），
+    所有写操作排队交给唯一的写线程串行执行
+    """
+    def __init__(self, filename: str, profile: str = 'durable'):
+        """
+        :param profile: 写连接的配置，必须是WAL模式的配置
+        """
+        self._filename = filename
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self._cache = ColumnCache(self.fetch_columns)  # 所有连接共用
+        self._queue = queue.Queue()
+        self._closed = False
+        self._error = None  # 写连接打开失败的原因
+        ready = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, args=(profile, ready), daemon=True)
+        self._writer.start()
+        ready.wait()  # 写连接先完成数据库升级并切换到WAL模式
+        if self._error is not None:
+            self._writer.join()
+            self._closed = True
+            raise self._error
+
+    def _write_loop(self, profile: str, ready: threading.Event):
+        try:
+            db = PassDatabase(self._filename, profile)
+            db._cache = self._cache
+        except BaseException as e:
+            self._error = e
+            return
         finally:
-            return is_valid
+            ready.set()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(db, *args))
+            except BaseException as e:
+                future.set_exception(e)
+        db.close()
+
+    @property
+    def column_cache(self):
+        return self._cache
+
+    def _reader(self) -> PassDatabase:
+        """
+        当前线程的只读连接，第一次使用时创建
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = PassDatabase(self._filename, 'readonly', check_same_thread=False)
+            db._cache = self._cache
+            self._local.db = db
+            with self._lock:
+                self._readers.append(db)
+        return db
+
+    def submit(self, func, *args) -> Future:
+        """
+        在写线程中执行func(db, *args)，db是写线程的PassDatabase
+        :return: Future
+        :raise RuntimeError: 已经调用过close()
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('database is closed')
+            self._queue.put((future, func, args))
+        return future
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+        self._filename = None
+
+    # 读操作：使用当前线程的连接
+
+    def select_all(self):
+        return self._reader().select_all()
+
+    def select_chunks(self, chunk_size: int = 1000, lazy: bool = False, after: int = 0, raise_errors: bool = False):
+        return self._reader().select_chunks(chunk_size, lazy, after, raise_errors)
+
+    def select_iter(self, chunk_size: int = 1000, lazy: bool = False):
+        return self._reader().select_iter(chunk_size, lazy)
+
+    def select_page(self, after: int = 0, limit: int = 1000, lazy: bool = False):
+        return self._reader().select_page(after, limit, lazy)
+
+    def fetch_columns(self, sn: int):
+        return self._reader().fetch_columns(sn)
+
+    def search(self, loc: str = None, usr: str = None, limit: int = -1):
+        return self._reader().search(loc, usr, limit)
+
+    def exists(self, loc: str, usr: str):
+        return self._reader().exists(loc, usr)
+
+    def data_version(self):
+        return self._reader().data_version()
+
+    def last_change(self):
+        return self._reader().last_change()
+
+    def changes_since(self, seq: int, lazy: bool = True):
+        return self._reader().changes_since(seq, lazy)
+
+    def reused_passwords(self, min_count: int = 2):
+        return self.submit(PassDatabase.reused_passwords, min_count).result()  # 需要补算哈希
+
+    # 写操作：交给写线程，等待完成
+
+    def insert(self, record: KeychainRecord):
+        return self.submit(PassDatabase.insert, record).result()
+
+    def insert_or_ignore(self, record: KeychainRecord):
+        return self.submit(PassDatabase.insert_or_ignore, record).result()
+
+    def upsert(self, record: KeychainRecord):
+        return self.submit(PassDatabase.upsert, record).result()
+
+    def insert_many(self, records, chunk_size: int = 500, ignore_duplicates: bool = False):
+        return self.submit(PassDatabase.insert_many, records, chunk_size, ignore_duplicates).result()
+
+    def update(self, record: KeychainRecord):
+        return self.submit(PassDatabase.update, record).result()
+
+    def update_many(self, records):
+        return self.submit(PassDatabase.update_many, records).result()
+
+    def delete(self, sn):
+        return self.submit(PassDatabase.delete, sn).result()
 
     @property
     def source(self):
         return self._filename
 
+
+class AsyncPassDatabase:
+    """
+    供asyncio使用的密码数据库：所有阻塞操作在专用的线程池中执行，不阻塞事件循环。
+    用await AsyncPassDatabase.open()创建，打开和升级数据库也在线程池中进行
+    """
+    def __init__(self, db: PooledPassDatabase, executor: ThreadPoolExecutor, max_workers: int):
+        self._db = db
+        self._executor = executor
+        self._slots = asyncio.Semaphore(max_workers)
+
+    @staticmethod
+    async def open(filename: str, profile: str = 'durable', max_workers: int = 4):
+        """
+        :param max_workers: 同时执行的数据库操作数上限
+        :return: AsyncPassDatabase
+        """
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='PassDB')
+        try:
+            loop = asyncio.get_running_loop()
+            db = await loop.run_in_executor(executor, PooledPassDatabase, filename, profile)
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return AsyncPassDatabase(db, executor, max_workers)
+
+    async def _run(self, func, *args):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def rows(self, chunk_size: int = 1000):
+        """
+        异步逐条产出所有记录（按id排序），每次从数据库读取一页。
+        记录包含所有列，使用时不会再访问数据库
+        """
+        after = 0
+        while True:
+            page = await self._run(self._db.select_page, after, chunk_size)
+            if len(page) == 0:
+                break
+            for record in page:
+                yield record
+            after = page[-1].sn
+
+    async def select_all(self):
+        return await self._run(self._db.select_all)
+
+    async def select_page(self, after: int = 0, limit: int = 1000, lazy: bool = False):
+        """
+        :param lazy: 延迟加载的记录访问pwd/ext时会阻塞，应改用await fetch_columns()读取
+        """
+        return await self._run(self._db.select_page, after, limit, lazy)
+
+    async def fetch_columns(self, sn: int):
+        return await self._run(self._db.fetch_columns, sn)
+
+    async def search(self, loc: str = None, usr: str = None, limit: int = -1):
+        return await self._run(self._db.search, loc, usr, limit)
+
+    async def exists(self, loc: str, usr: str):
+        return await self._run(self._db.exists, loc, usr)
+
+    async def insert(self, record: KeychainRecord):
+        return await self._run(self._db.insert, record)
+
+    async def insert_or_ignore(self, record: KeychainRecord):
+        return await self._run(self._db.insert_or_ignore, record)
+
+    async def upsert(self, record: KeychainRecord):
+        return await self._run(self._db.upsert, record)
+
+    async def insert_many(self, records, chunk_size: int = 500, ignore_duplicates: bool = False):
+        return await self._run(self._db.insert_many, records, chunk_size, ignore_duplicates)
+
+    async def update(self, record: KeychainRecord):
+        return await self._run(self._db.update, record)
+
+    async def update_many(self, records):
+        return await self._run(self._db.update_many, records)
+
+    async def delete(self, sn):
+        return await self._run(self._db.delete, sn)
+
+    @property
+    def source(self):
+        return self._db.source
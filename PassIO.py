@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+导入浏览器和其他密码管理器导出的文件，以及把数据库导出为文件。
+导入流水线：逐行解析 -> 规范化 -> 分批插入（(loc, usr)重复的记录由唯一索引跳过）；
+导出按id顺序分批读取、逐条写出。两者的内存占用都与记录数无关
+"""
+
+import csv
+import gzip
+import json
+from itertools import islice
+from urllib.parse import urlparse, parse_qs, unquote, quote
+
+from PassDB import PassDatabase, KeychainRecord
+from otpauth import OtpAuth
+
+
+class ColumnMapping:
+    """
+    导出文件的列与Keychain各列的对应关系
+    """
+    def __init__(self, name: str, loc: str, usr: str, pwd: str, title: str = None, otp: str = None, ext: str = None,
+                 require_pwd: bool = True):
+        """
+        :param loc: location所在的列（一般是URL）
+        :param title: loc为空时使用的列（条目名称）
+        :param otp: OTP所在的列，内容是otpauth://链接或者Base32编码的密钥
+        :param ext: 原样保存到ext的列
+        :param require_pwd: pwd为空的行是否丢弃。本程序导出的文件中可能有没有密码的记录（例如只有OTP）
+        """
+        self.name = name
+        self.loc = loc
+        self.usr = usr
+        self.pwd = pwd
+        self.title = title
+        self.otp = otp
+        self.ext = ext
+        self.require_pwd = require_pwd
+
+    def matches(self, header) -> bool:
+        return all(c in header for c in (self.loc, self.usr, self.pwd))
+
+    def convert(self, row: dict):
+        """
+        :return: KeychainRecord，缺少必要的列时为None
+        """
+        loc = (row.get(self.loc) or '').strip()
+        if len(loc) == 0 and self.title is not None:
+            loc = (row.get(self.title) or '').strip()
+        usr = (row.get(self.usr) or '').strip()
+        pwd = row.get(self.pwd) or None
+        if len(loc) == 0 or len(usr) == 0 or (pwd is None and self.require_pwd):
+            return None
+        ext = None
+        if self.ext is not None:
+            ext = row.get(self.ext) or None
+        elif self.otp is not None:
+            ext = otp_to_ext((row.get(self.otp) or '').strip(), usr, loc)
+        return KeychainRecord(loc, usr, pwd, ext)
+
+
+# 按顺序检测，列名更多的格式放在前面
+MAPPINGS = [
+    ColumnMapping('bitwarden', 'login_uri', 'login_username', 'login_password', title='name', otp='login_totp'),
+    ColumnMapping('keepass', 'URL', 'Username', 'Password', title='Title', otp='TOTP'),
+    ColumnMapping('chrome', 'url', 'username', 'password', title='name'),
+    ColumnMapping('firefox', 'url', 'username', 'password'),
+    ColumnMapping('passstore', 'loc', 'usr', 'pwd', ext='ext', require_pwd=False),  # 本程序导出的CSV/JSON Lines
+]
+
+
+def find_mapping(name: str) -> ColumnMapping:
+    return next((m for m in MAPPINGS if m.name == name), None)
+
+
+def detect_mapping(header) -> ColumnMapping:
+    return next((m for m in MAPPINGS if m.matches(header)), None)
+
+
+def otp_to_ext(value: str, name: str, issuer: str):
+    """
+    把导出文件中的OTP转换为ext中的JSON（与main.OneTimePass.to_json()相同），只支持TOTP
+    """
+    if len(value) == 0:
+        return None
+    if value.startswith('otpauth://'):
+        uri = urlparse(value)
+        if uri.netloc.lower() != 'totp':
+            return None
+        query = parse_qs(uri.query)
+        secret = query.get('secret', [''])[0]
+        issuer = query.get('issuer', [issuer])[0]
+        label = unquote(uri.path.lstrip('/'))
+        name = label.split(':', 1)[-1] or name
+    elif '://' in value:  # steam://等不支持
+        return None
+    else:
+        secret = value
+    secret = secret.replace(' ', '').upper()
+    if len(secret) == 0:
+        return None
+    return json.dumps({'type': 'totp', 'name': name, 'secret': secret, 'issuer': issuer})
+
+
+def read_records(filename: str, mapping: ColumnMapping = None):
+    """
+    逐条读取导出文件中的记录
+    :param mapping: 为空时根据CSV的表头自动识别
+    :return: 每行产出一个KeychainRecord，缺少必要的列的行产出None
+    """
+    if filename.lower().endswith(('.jsonl', '.ndjson')):
+        mapping = mapping or find_mapping('passstore')
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+                yield mapping.convert(json.loads(line))
+        return
+    with open(filename, encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        mapping = mapping or detect_mapping(reader.fieldnames or [])
+        if mapping is None:
+            raise ValueError(f'unknown format: {reader.fieldnames}')
+        for row in reader:
+            yield mapping.convert(row)
+
+
+def import_file(db: PassDatabase, filename: str, mapping: ColumnMapping = None, batch_size: int = 1000, progress=None):
+    """
+    把导出文件导入数据库，(loc, usr)已经存在的记录被跳过。所有记录在同一个事务中提交
+    :param progress: progress(已读取条数, 已插入条数)，每一批调用一次
+    :return: (已读取条数, 已插入条数, 已经存在的条数, 缺少必要的列而丢弃的条数)
+    """
+    rows = read_records(filename, mapping)
+    count = 0
+    inserted = 0
+    rejected = 0
+    profile = db.profile
+    db.set_profile('bulk-import')
+    try:
+        with db.transaction():
+            while True:
+                batch = list(islice(rows, batch_size))
+                if len(batch) == 0:
+                    break
+                count += len(batch)
+                records = [r for r in batch if r is not None]
+                rejected += len(batch) - len(records)
+                inserted += db.insert_many(records, ignore_duplicates=True)
+                if progress is not None:
+                    progress(count, inserted)
+    finally:
+        db.set_profile(profile)
+    return count, inserted, count - rejected - inserted, rejected
+
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'otpauth')
+
+
+def export_format(filename: str):
+    """
+    根据扩展名确定导出格式和是否压缩，例如a.csv、a.jsonl.gz、a.otpauth.txt
+    :return: (格式, 是否gzip压缩)
+    """
+    name = filename.lower()
+    compress = name.endswith('.gz')
+    if compress:
+        name = name[:-3]
+    fmt = next((f for f in EXPORT_FORMATS if f'.{f}' in name), 'csv')
+    return fmt, compress
+
+
+def otp_uri(record: KeychainRecord):
+    """
+    :return: 记录中TOTP的otpauth://链接，没有则为None
+    """
+    try:
+        cfg = json.loads(record.ext)
+        if cfg['type'].lower() != 'totp':
+            return None
+        label = quote(f"{cfg['issuer']}:{cfg['name']}")
+        return OtpAuth(cfg['secret']).to_uri('totp', label, quote(cfg['issuer']))
+    except Exception:
+        return None
+
+
+def export_file(db: PassDatabase, filename: str, fmt: str = None, compress: bool = None,
+                after: int = 0, chunk_size: int = 1000, progress=None):
+    """
+    按id顺序把记录导出到文件，每次只读取一批。
+    中断后可以把上次返回（或progress报告）的id作为after继续导出，新内容追加到文件末尾
+    :param fmt: csv、jsonl或otpauth（每行一个链接，只导出有TOTP的记录），为空时由扩展名决定
+    :param compress: 是否gzip压缩，为空时由扩展名决定
+    :param after: 从id大于after的记录开始导出
+    :param progress: progress(已导出条数, 最后导出的id)，每一批调用一次
+    :return: (已导出条数, 最后导出的id)
+    """
+    guess_fmt, guess_compress = export_format(filename)
+    fmt = fmt or guess_fmt
+    compress = guess_compress if compress is None else compress
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'unknown format: {fmt}')
+    mode = 'at' if after > 0 else 'wt'
+    if compress:  # 追加时会产生多段gzip数据，gzip仍然可以完整解压
+        f = gzip.open(filename, mode, encoding='utf-8', newline='')
+    else:
+        f = open(filename, mode, encoding='utf-8', newline='')
+    count = 0
+    last = after
+    with f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer is not None and after == 0:
+            writer.writerow(('id', 'loc', 'usr', 'pwd', 'ext'))
+        for chunk in db.select_chunks(chunk_size, after=after, raise_errors=True):  # 读取出错时不能当作导出完成
+            for r in chunk:
+                if fmt == 'csv':
+                    writer.writerow((r.sn, r.loc, r.usr, r.pwd, r.ext or ''))
+                elif fmt == 'jsonl':
+                    row = {'id': r.sn, 'loc': r.loc, 'usr': r.usr, 'pwd': r.pwd, 'ext': r.ext}
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                else:
+                    uri = otp_uri(r)
+                    if uri is None:
+                        continue
+                    f.write(uri + '\n')
+                count += 1
+            last = chunk[-1].sn
+            f.flush()
+            if progress is not None:
+                progress(count, last)
+    return count, last
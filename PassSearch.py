@@ -0,0 +1,452 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+主界面输入框的即时搜索：location、username、password三个输入框依次过滤记录
+"""
+
+import time
+import queue
+import sqlite3
+import threading
+from collections import deque
+from heapq import heappush, heappushpop
+
+from PassDB import PassDatabase, RecordSnapshot, fold_case
+
+# 模糊匹配的打分，参考fzf：每个匹配的字符得分，连续匹配、单词开头、整个字符串开头有额外加分，间隔扣分
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+BONUS_BOUNDARY = 8
+BONUS_CONSECUTIVE = 4
+BONUS_FIRST_CHAR_MULTIPLIER = 2  # 查询的第一个字符的加分加倍
+BONUS_PREFIX = 16
+DELIMITERS = '/.:-_@ '
+
+CHECK_INTERVAL = 4096  # 每处理多少条记录检查一次搜索是否被取消
+
+
+class SearchCancelled(Exception):
+    """
+    有了更新的查询，当前的搜索被放弃
+    """
+    pass
+
+
+def _batches(candidates, cancelled):
+    """
+    把候选下标分批产出，每一批之前检查是否被取消
+    :param cancelled: cancelled() -> 是否应当放弃搜索，为空时不检查
+    """
+    if cancelled is None:
+        yield candidates
+        return
+    for start in range(0, len(candidates), CHECK_INTERVAL):
+        if cancelled():
+            raise SearchCancelled()
+        yield candidates[start:start + CHECK_INTERVAL]
+
+
+def is_subsequence(query: str, text: str, start: int = 0, end: int = None) -> bool:
+    """
+    query的字符是否按顺序出现在text[start:end]中（贪心匹配，每个字符取最早的位置）
+    """
+    if end is None:
+        end = len(text)
+    find = text.find
+    pos = start
+    for c in query:
+        pos = find(c, pos, end)
+        if pos < 0:
+            return False
+        pos += 1
+    return True
+
+
+def subsequence_filter(records, field: str):
+    """
+    按子序列匹配过滤loc或usr（输入"abc"匹配"a.*b.*c"，不区分大小写），
+    直接在打包好的小写字符串上查找，不用正则表达式
+    :param records: RecordStore或RecordSnapshot
+    :param field: 'loc'或'usr'
+    :return: filter(查询内容, 候选下标列表, cancelled=None) -> 匹配的下标列表
+    """
+    def filter(query: str, candidates, cancelled=None):
+        query = fold_case(query)
+        packed, ends, overrides = records.folded(field)
+        find = packed.find
+        hits = []
+        for batch in _batches(candidates, cancelled):
+            for i in batch:
+                if i in overrides:
+                    if is_subsequence(query, overrides[i]):
+                        hits.append(i)
+                    continue
+                pos = ends[i - 1] if i > 0 else 0
+                end = ends[i]
+                if find(query, pos, end) >= 0:  # 连续出现时一次查找即可确定
+                    hits.append(i)
+                    continue
+                for c in query:
+                    pos = find(c, pos, end)
+                    if pos < 0:
+                        break
+                    pos += 1
+                else:
+                    hits.append(i)
+        return hits
+    return filter
+
+
+def text_filter(column):
+    """
+    按子序列匹配过滤没有预先转换大小写的列（例如按需读取的pwd）
+    :param column: column(下标) -> 该列的内容
+    """
+    def filter(query: str, candidates, cancelled=None):
+        query = fold_case(query)
+        hits = []
+        for batch in _batches(candidates, cancelled):
+            hits.extend(i for i in batch if is_subsequence(query, fold_case(column(i))))
+        return hits
+    return filter
+
+
+def fuzzy_score(query: str, text: str):
+    """
+    模糊匹配的得分（两者都应是小写形式）。
+    先正向找到最早结束的匹配，再从结束处反向找到最晚的开始，在这个最短的区间内计分
+    :return: 得分，不匹配时为None
+    """
+    if len(query) == 0:
+        return 0
+    find = text.find
+    pos = 0
+    for c in query:
+        pos = find(c, pos)
+        if pos < 0:
+            return None
+        pos += 1
+    end = pos
+    rfind = text.rfind
+    for c in reversed(query):
+        pos = rfind(c, 0, pos)
+    start = pos
+    score = 0
+    prev = -1
+    pos = start
+    for k, c in enumerate(query):
+        pos = find(c, pos, end)
+        if pos == 0 or text[pos - 1] in DELIMITERS:
+            bonus = BONUS_BOUNDARY
+        else:
+            bonus = 0
+        if prev >= 0 and pos == prev + 1:
+            bonus = max(bonus, BONUS_CONSECUTIVE)
+        elif prev >= 0:
+            score += SCORE_GAP_START + SCORE_GAP_EXTENSION * (pos - prev - 2)
+        if k == 0:
+            bonus *= BONUS_FIRST_CHAR_MULTIPLIER
+        score += SCORE_MATCH + bonus
+        prev = pos
+        pos += 1
+    if start == 0:
+        score += BONUS_PREFIX
+    return score
+
+
+def top_k(items, key, k: int, cancelled=None):
+    """
+    用大小为k的最小堆选出key最大的k项，不对全部结果排序。得分相同时先出现的在前
+    :return: 按key从大到小排列的列表
+    """
+    if k <= 0:
+        return []
+    heap = []
+    for order, item in enumerate(items):
+        if cancelled is not None and order % CHECK_INTERVAL == 0 and cancelled():
+            raise SearchCancelled()
+        entry = (key(item), -order, item)
+        if len(heap) < k:
+            heappush(heap, entry)
+        elif entry > heap[0]:
+            heappushpop(heap, entry)
+    return [item for _, _, item in sorted(heap, reverse=True)]
+
+
+class NarrowingSearch:
+    """
+    逐字输入时的增量搜索。
+    每个输入框保存一个栈，依次是各个前缀查询的结果：追加字符时只需在上一个结果中过滤，
+    删除字符时直接弹出栈顶，回到已经算过的结果。某一级的结果变了，后面各级的栈随之作废
+    """
+    def __init__(self, filters):
+        """
+        :param filters: 每个输入框的过滤函数，见subsequence_filter()
+        """
+        self._filters = filters
+        self._stacks = [[] for _ in filters]  # 每一级：[(查询内容, 结果), ...]，后一项的查询以前一项为前缀
+        self._inputs = [None] * len(filters)  # 每一级上次的输入（上一级的结果）
+
+    def reset(self):
+        for stack in self._stacks:
+            stack.clear()
+        self._inputs = [None] * len(self._filters)
+
+    def search(self, candidates, queries, cancelled=None):
+        """
+        :param candidates: 所有候选记录的下标，内容不变时应传入同一个列表对象
+        :param queries: 每个输入框的内容
+        :param cancelled: 见_batches()。被取消时抛出SearchCancelled，已经缓存的结果不受影响
+        :return: 匹配的下标列表
+        """
+        hits = candidates
+        for k, query in enumerate(queries):
+            stack = self._stacks[k]
+            if self._inputs[k] is not hits:
+                stack.clear()
+                self._inputs[k] = hits
+            if len(query) == 0:
+                stack.clear()
+                continue
+            while len(stack) > 0 and not query.startswith(stack[-1][0]):
+                stack.pop()
+            if len(stack) > 0 and stack[-1][0] == query:
+                hits = stack[-1][1]
+                continue
+            hits = self._filters[k](query, stack[-1][1] if len(stack) > 0 else hits, cancelled)
+            stack.append((query, hits))
+        return hits
+
+
+class RecordSearch:
+    """
+    在RecordSnapshot中按location、username、password搜索，快照变化后丢弃缓存的结果。
+    只能在一个线程（SearchWorker）中使用：pwd通过该线程自己的只读连接读取
+    """
+    def __init__(self, limit: int = 5):
+        """
+        :param limit: 最多返回的记录数
+        """
+        self._limit = limit
+        self._snapshot = None
+        self._narrowing = None
+        self._source = None
+        self._db = None  # 读取pwd的只读连接
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        self._limit = value
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._source = None
+
+    def _open(self, source: str):
+        if source == self._source:
+            return
+        self.close()
+        self._source = source
+        if source is None:
+            return
+        try:
+            self._db = PassDatabase(source, 'readonly')
+        except sqlite3.Error as e:
+            print(f'cannot read passwords of {source}: {e}')
+
+    def _password(self, index: int):
+        pwd = self._snapshot.replaced_pwd(index)
+        if pwd is not None or self._db is None:
+            return pwd
+        return self._db.column_cache.get(self._snapshot.sn(index))[0]
+
+    def matches(self, snapshot: RecordSnapshot, source: str, loc: str, usr: str, pwd: str, cancelled=None):
+        """
+        :param source: 数据库文件，用于读取pwd
+        :return: 匹配的记录的下标列表，按存储顺序
+        """
+        if snapshot is not self._snapshot:
+            self._snapshot = snapshot
+            self._narrowing = NarrowingSearch([
+                subsequence_filter(snapshot, 'loc'),
+                subsequence_filter(snapshot, 'usr'),
+                text_filter(self._password),
+            ])
+        self._open(source)
+        return self._narrowing.search(snapshot.indices(), (loc, usr, pwd), cancelled)
+
+    def rank(self, hits, loc: str, usr: str, cancelled=None):
+        """
+        按loc和usr的模糊匹配得分选出最好的limit条（pwd不参与打分）
+        """
+        queries = [(fold_case(q), self._snapshot.folded(f)) for q, f in ((loc, 'loc'), (usr, 'usr')) if len(q) > 0]
+        if len(queries) == 0:
+            return hits[:self._limit]
+
+        def score(i):
+            total = 0
+            for query, (packed, ends, overrides) in queries:
+                text = overrides[i] if i in overrides else packed[ends[i - 1] if i > 0 else 0:ends[i]]
+                total += fuzzy_score(query, text) or 0
+            return total
+        return top_k(hits, score, self._limit, cancelled)
+
+    def search(self, snapshot: RecordSnapshot, source: str, loc: str, usr: str, pwd: str, cancelled=None):
+        """
+        :return: 得分最高的limit条记录的下标列表
+        """
+        hits = self.matches(snapshot, source, loc, usr, pwd, cancelled)
+        return self.rank(hits, loc, usr, cancelled)
+
+
+class SearchWorker:
+    """
+    后台搜索线程：请求放入队列，线程只执行其中最新的一个，结果放入results队列
+    """
+    def __init__(self, search, on_exit=None):
+        """
+        :param search: search(*请求, cancelled=...) -> 结果，在后台线程中执行
+        :param on_exit: 线程退出前在该线程中调用，用于关闭search使用的连接
+        """
+        self._search = search
+        self._on_exit = on_exit
+        self._requests = queue.Queue()
+        self.results = queue.Queue()  # (编号, 结果, 异常, 耗时)，搜索出错时结果为None
+        self._thread = threading.Thread(target=self._loop, name='PassSearch', daemon=True)
+        self._thread.start()
+
+    def submit(self, generation: int, request, cancelled):
+        """
+        :param cancelled: cancelled() -> 是否已经有了更新的请求
+        """
+        self._requests.put((generation, request, cancelled))
+
+    def close(self):
+        self._requests.put(None)
+
+    def _loop(self):
+        while True:
+            item = self._requests.get()
+            while item is not None:  # 跳过已经过时的请求
+                try:
+                    item = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                break
+            generation, request, cancelled = item
+            if cancelled():
+                continue
+            start = time.perf_counter()
+            try:
+                result = self._search(*request, cancelled=cancelled)
+            except SearchCancelled:
+                continue
+            except Exception as e:  # 出错也要告知调度者，否则它会一直等待这个结果
+                print(f'search failed: {e}')
+                self.results.put((generation, None, e, time.perf_counter() - start))
+                continue
+            self.results.put((generation, result, None, time.perf_counter() - start))
+        if self._on_exit is not None:
+            self._on_exit()
+
+
+class SearchScheduler:
+    """
+    输入框的搜索调度（在Tk的事件循环中）：按键后等待delay毫秒再把请求交给SearchWorker，期间又有输入就取消之前的计划。
+    每次输入都有一个递增的编号，后台正在执行的旧搜索会自行放弃，只有最新一次输入的结果会被显示。
+    结果用after()定时从队列中取出，界面从不等待搜索
+    """
+    def __init__(self, widget, worker: SearchWorker, apply, on_error=None,
+                 delay: int = 150, poll: int = 30, history: int = 100):
+        """
+        :param widget: 提供after()/after_cancel()的Tk控件
+        :param apply: apply(结果)，显示搜索结果
+        :param on_error: on_error(异常)，最新一次搜索出错时调用
+        :param delay: 最后一次按键后等待的毫秒数
+        :param poll: 等待结果时检查队列的间隔（毫秒）
+        :param history: 保留最近多少次搜索的耗时
+        """
+        self._widget = widget
+        self._worker = worker
+        self._apply = apply
+        self._on_error = on_error
+        self._delay = delay
+        self._poll = poll
+        self._pending = None  # after()返回的id
+        self._drainer = None  # 检查结果队列的after()的id
+        self._request = None
+        self._generation = 0  # 每次输入加1
+        self._submitted = None  # 已经交给后台、尚未得到结果的请求编号
+        self._latency = deque(maxlen=history)  # 最近几次搜索的耗时（秒）
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def schedule(self, *request):
+        self._generation += 1
+        self._request = request
+        if self._pending is not None:
+            self._widget.after_cancel(self._pending)
+        self._pending = self._widget.after(self._delay, self._submit, self._generation)
+
+    def cancel(self):
+        """
+        取消尚未执行和正在执行的搜索
+        """
+        self._generation += 1
+        self._submitted = None
+        for after_id in (self._pending, self._drainer):
+            if after_id is not None:
+                self._widget.after_cancel(after_id)
+        self._pending = self._drainer = None
+
+    def _submit(self, generation: int):
+        self._pending = None
+        if generation != self._generation:
+            return
+        self._worker.submit(generation, self._request, lambda: generation != self._generation)
+        self._submitted = generation
+        if self._drainer is None:
+            self._drainer = self._widget.after(self._poll, self._drain)
+
+    def _drain(self):
+        self._drainer = None
+        while True:
+            try:
+                generation, result, error, elapsed = self._worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self._generation:
+                continue
+            self._submitted = None
+            if error is None:
+                self._latency.append(elapsed)
+                self._apply(result)
+            elif self._on_error is not None:
+                self._on_error(error)
+        if self._submitted is not None:
+            self._drainer = self._widget.after(self._poll, self._drain)
+
+    def stats(self):
+        """
+        :return: 最近几次搜索的耗时统计（毫秒）：{'count', 'mean', 'p50', 'p95', 'max'}，还没有搜索过时为None
+        """
+        if len(self._latency) == 0:
+            return None
+        latency = sorted(self._latency)
+        n = len(latency)
+        return {
+            'count': n,
+            'mean': sum(latency) / n * 1000,
+            'p50': latency[n // 2] * 1000,
+            'p95': latency[min(n - 1, n * 95 // 100)] * 1000,
+            'max': latency[-1] * 1000,
+        }
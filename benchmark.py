@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+性能测试，用法：python benchmark.py [测试名 ...]，不带参数则运行全部
+"""
+
+import os
+import sys
+import re
+import time
+import tempfile
+import tracemalloc
+
+from PassDB import PassDatabase, KeychainRecord, RecordStore, PROFILES
+from PassSearch import subsequence_filter
+
+
+def make_records(n: int, start: int = 0):
+    for i in range(start, start + n):
+        yield KeychainRecord(f'https://site{i}.example.com/login', f'user{i % 997}@example.com', f'pass-{i:08d}')
+
+
+def timed(func, *args, **kw):
+    start = time.perf_counter()
+    func(*args, **kw)
+    return time.perf_counter() - start
+
+
+def seconds(t):
+    return f'{"-":>12}' if t is None else f'{t:>11.3f}s'
+
+
+def bench_profiles(rows: int = 20000, singles: int = 200):
+    """
+    比较各个连接配置：批量插入、逐条插入（每条一次提交）、全部读取、搜索
+    """
+    print(f'{"profile":<12} {"insert_many":>12} {"insert x%d" % singles:>12} {"select_all":>12} {"search":>12}')
+    with tempfile.TemporaryDirectory() as folder:
+        for profile in PROFILES:
+            filename = os.path.join(folder, f'{profile}.sqlite3')
+            PassDatabase.create_db(filename).close()
+            if profile == 'readonly':  # 只读配置只测读取，数据用默认配置准备
+                db = PassDatabase(filename)
+                db.insert_many(make_records(rows))
+                db.close()
+                t_many = t_single = None
+                db = PassDatabase(filename, profile)
+            else:
+                db = PassDatabase(filename, profile)
+                t_many = timed(db.insert_many, make_records(rows))
+                t_single = timed(lambda: [db.insert(r) for r in make_records(singles, rows)])
+            t_select = timed(db.select_all)
+            t_search = timed(lambda: [db.search(loc=f'site{i}1', limit=5) for i in range(100)])
+            db.close()
+            print(f'{profile:<12}', *(seconds(t) for t in (t_many, t_single, t_select, t_search)))
+
+
+class LegacyRecord:
+    """
+    旧版KeychainRecord的内存布局：实例__dict__加上每条记录一个set()
+    """
+    def __init__(self, location, username=None, password=None, extra=None, sn=0):
+        self._sn = sn
+        self._loc = location
+        self._usr = username
+        self._pwd = password
+        self._ext = extra
+        self._dirty_flags = set()
+
+
+def bench_record_memory(rows: int = 100000):
+    """
+    比较旧版和__slots__版记录对象本身占用的内存（字段字符串共用，不计入）
+    """
+    loc, usr, pwd = 'https://example.com/login', 'user@example.com', 'secret'
+    for name, cls in (('legacy', LegacyRecord), ('slots', KeychainRecord)):
+        tracemalloc.start()
+        records = [cls(loc, usr, pwd, None, i) for i in range(rows)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:<8} {size / rows:>8.1f} bytes/record  {size / 2 ** 20:>8.1f} MiB for {rows} records')
+        del records
+
+
+def legacy_filter(column):
+    """
+    旧版on_input_changed的过滤方式：每次把输入编译成"a.*b.*c"的正则表达式
+    """
+    def filter(query: str, candidates):
+        regex = re.compile('.*'.join(re.escape(each) for each in query), re.IGNORECASE)
+        return [i for i in candidates if regex.search(column(i)) is not None]
+    return filter
+
+
+def bench_search(rows: int = 100000):
+    """
+    比较正则表达式和子序列匹配过滤全部记录的耗时，两者的结果必须相同
+    """
+    records = RecordStore()
+    records.extend(make_records(rows))
+    candidates = records.indices()
+    records.folded('loc'), records.folded('usr')  # 打包的字符串在第一次读取时才拼接
+    print(f'{"field":<6} {"query":<16} {"hits":>8} {"regex":>12} {"subsequence":>12} {"speed-up":>9}')
+    for field, column, queries in (('loc', records.loc, ('s', 'site', 'st9cm', 'HTTPS9LOGIN', 'xyz')),
+                                   ('usr', records.usr, ('u', 'user9', 'u1@e.c', 'EXAMPLE.COM'))):
+        legacy, fast = legacy_filter(column), subsequence_filter(records, field)
+        for query in queries:
+            t_legacy = timed(legacy, query, candidates)
+            t_fast = timed(fast, query, candidates)
+            hits = fast(query, candidates)
+            assert hits == legacy(query, candidates)
+            print(f'{field:<6} {query:<16} {len(hits):>8}', seconds(t_legacy), seconds(t_fast), f'{t_legacy / t_fast:>8.1f}x')
+
+
+BENCHMARKS = {
+    'profiles': bench_profiles,
+    'record-memory': bench_record_memory,
+    'search': bench_search,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f'== {name} ==')
+        BENCHMARKS[name]()
@@ -4,8 +4,8 @@
 # common builtin modules
 import os
 import enum
-import re
 import json
+import threading
 
 # GUI modules
 import tkinter as tk
@@ -20,17 +20,25 @@ import pystray
 
 from otpauth import OtpAuth
 # custom defined modules
-from PassDB import PassDatabase, KeychainRecord
+from PassDB import PassDatabase, KeychainRecord, RecordStore, DuplicateEntriesError
+import PassIO
+import PassBreach
+from PassSearch import RecordSearch, SearchWorker, SearchScheduler
 
 
 class MenuId(enum.IntEnum):
     INVALID = -1
 
     DATABASE_CLOSE = 2
+    DATABASE_BACKUP = 3
+    DATABASE_IMPORT = 4
+    DATABASE_EXPORT = 5
 
     PASS_INSERT = 0  # 子菜单的索引，从零开始
     PASS_UPDATE = 1
     PASS_DELETE = 2
+    PASS_REUSED = 3
+    PASS_BREACHED = 4
 
     PASS_ITEM = 2     # 顶层菜单的索引，从一开始
 
@@ -344,6 +352,9 @@ class MainApp(tk.Tk):
     TITLE = 'PassStore'
     EVENT_DB_EXIST = '<<DBExist>>'  # sent when database is opened / closed.
     TREEVIEW_MAX = 5
+    SEARCH_DELAY = 150  # 最后一次按键后等待多久再搜索（毫秒）
+    POLL_INTERVAL = 2000  # 检查数据库是否被其他程序修改的间隔（毫秒）
+    BACKUP_KEEP = 3       # 保留的旧备份个数
 
     def __init__(self, *a, **kw):
         tk.Tk.__init__(self, *a, **kw)
@@ -362,6 +373,12 @@ class MainApp(tk.Tk):
         menu.add_command(label='Open', command=self.menu_database_open)
         menu.add_command(label='Close', command=self.menu_database_close)
         self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.DATABASE_CLOSE)
+        menu.add_command(label='Backup', command=self.menu_database_backup)
+        self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.DATABASE_BACKUP)
+        menu.add_command(label='Import', command=self.menu_database_import)
+        self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.DATABASE_IMPORT)
+        menu.add_command(label='Export', command=self.menu_database_export)
+        self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.DATABASE_EXPORT)
         menu.add_separator()
         menu.add_command(label='Quit', command=self.quit_app)
         menu_bar.add_cascade(label='Database', menu=menu)
@@ -373,10 +390,15 @@ class MainApp(tk.Tk):
         self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.PASS_UPDATE)
         menu.add_command(label='Delete', command=self.menu_delete_pass)
         self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.PASS_DELETE)
+        menu.add_command(label='Reused', command=self.menu_reused_pass)
+        self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.PASS_REUSED)
+        menu.add_command(label='Breached', command=self.menu_breached_pass)
+        self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.PASS_BREACHED)
         menu_bar.add_cascade(label='PassItem', menu=menu)
         self.add_listener(menu_bar, MainApp.EVENT_DB_EXIST, MenuId.PASS_ITEM)
         #
         menu = tk.Menu(menu_bar, tearoff=0)
+        menu.add_command(label='Search Stats', command=self.menu_help_search_stats)
         menu.add_command(label='About', command=self.menu_help_about)
         menu_bar.add_cascade(label='Help', menu=menu)
         self.config(menu=menu_bar)
@@ -429,7 +451,16 @@ class MainApp(tk.Tk):
         self.bind('<Escape>', lambda e: self.hide_to_systray())
         # database
         self._db = None       # PassDatabase
-        self._records = []  # 数据库所有记录一次性读取出来
+        self._poller = None   # after()返回的id
+        self._change_seq = 0  # 已经应用到self._records的修改日志序号
+        self._data_version = None
+        self._backup = None   # 正在执行备份的线程
+        self._backup_state = None  # [已完成比例, 是否成功]，由备份线程写入
+        self._records = RecordStore()  # 数据库所有记录，列式存储
+        search = RecordSearch(MainApp.TREEVIEW_MAX)  # 输入框的增量搜索，只在后台线程中使用
+        self._worker = SearchWorker(search.search, search.close)
+        self._scheduler = SearchScheduler(self, self._worker, self.show_hits, lambda e: self.show_hits([]),
+                                          MainApp.SEARCH_DELAY)
 
     def init_systray_resource(self):
         self._icon = Image.new(mode='RGB', size=(32, 32), color='black')
@@ -477,33 +508,15 @@ class MainApp(tk.Tk):
         return True
 
     def on_input_changed(self, loc: str, usr: str, pwd: str):
-        hits = list(self._records)
-        # 1. location
-        if len(loc) != 0:
-            loc = [re.escape(each) for each in loc]
-            pattern = '.*'.join(loc)
-            regex = re.compile(pattern, re.IGNORECASE)
-            hits[:] = [i for i in hits if regex.search(i.loc) is not None]
-            if len(hits) == 0:
-                self._tv.delete(*self._tv.get_children(''))
-                return
-        # 2. username
-        if len(usr) != 0:
-            usr = [re.escape(each) for each in usr]
-            pattern = '.*'.join(usr)
-            regex = re.compile(pattern, re.IGNORECASE)
-            hits[:] = [i for i in hits if regex.search(i.usr) is not None]
-            if len(hits) == 0:
-                self._tv.delete(*self._tv.get_children(''))
-                return
-        # 3. password
-        if len(pwd) != 0:
-            pwd = [re.escape(each) for each in pwd]
-            pattern = '.*'.join(pwd)
-            regex = re.compile(pattern, re.IGNORECASE)
-            hits[:] = [i for i in hits if regex.search(i.pwd) is not None]
-        #
-        self.refresh_treeview(hits)
+        """
+        输入停顿后才搜索，搜索在后台线程中对记录的快照进行，不阻塞界面
+        """
+        source = None if self._db is None else self._db.source
+        self._scheduler.schedule(self._records.snapshot(), source, loc, usr, pwd)
+
+    def show_hits(self, hits):
+        # 搜索期间被删除的记录不显示
+        self.refresh_treeview(self._records.view(i) for i in hits if self._records.is_alive(i))
 
     def menu_database_new(self):
         filename = filedialog.asksaveasfilename(defaultextension='.sqlite3')
@@ -512,10 +525,15 @@ class MainApp(tk.Tk):
         if os.path.exists(filename):
             messagebox.showinfo(MainApp.TITLE, 'Please delete it in File Explorer')
             return
+        self.stop_polling()
+        self._scheduler.cancel()  # 旧的搜索结果是旧记录集合的下标
         self._db = PassDatabase.create_db(filename)
-        self._records.clear()
+        self._records = RecordStore(None if self._db is None else self._db.column_cache)
         self.event_generate(MainApp.EVENT_DB_EXIST, state=1)
         self.title('[%s] %s' % (MainApp.TITLE, os.path.basename(filename)))
+        if self._db is not None:
+            self._change_seq = self._db.last_change()
+            self.start_polling()
 
     def menu_database_open(self):
         option = {'filetypes': [('SQLite3 File', ('*.db3', '*.s3db', '*.sqlite3', '*.sl3')),
@@ -526,31 +544,139 @@ class MainApp(tk.Tk):
         # if same database, ignore
         if self._db is not None and self._db.source == filename:
             return
-        # if unknown database, ignore
-        if not PassDatabase.validate(filename):
+        # if unknown database, ignore. the validated connection is used afterwards
+        try:
+            db = PassDatabase.open(filename)
+        except DuplicateEntriesError as e:
+            messagebox.showerror(MainApp.TITLE, str(e))
+            return
+        if db is None:
             messagebox.showerror(MainApp.TITLE, 'Wrong database format')
             return
         if self._db is not None:
             self.menu_database_close()
-        self._db = PassDatabase(filename)
-        self._records = self._db.select_all()
-        self.refresh_treeview(self._records)
+        self._db = db
+        self.load_records()
         self.event_generate(MainApp.EVENT_DB_EXIST, state=1)
-        self.title('[%s] %s (%d entries)' % (MainApp.TITLE, os.path.basename(filename), len(self._records)))
+        self.start_polling()
+
+    def load_records(self):
+        """
+        从数据库读取所有记录，代替self._records
+        """
+        self._scheduler.cancel()
+        filename = os.path.basename(self._db.source)
+        self._change_seq = self._db.last_change()  # 读取期间的修改由下一次apply_changes()补上
+        self._records = RecordStore(self._db.column_cache)
+        for chunk in self._db.select_chunks(lazy=True):  # 密码等列在使用时才读取
+            self._records.extend(chunk)
+            if len(self._tv.get_children('')) < MainApp.TREEVIEW_MAX:
+                self.refresh_treeview(self._records)
+            self.title('[%s] %s (loading %d entries...)' % (MainApp.TITLE, filename, len(self._records)))
+            self.update_idletasks()  # 只刷新界面，不处理用户输入
+        self.title('[%s] %s (%d entries)' % (MainApp.TITLE, filename, len(self._records)))
 
     def menu_database_close(self):
         if self._db is None:
             return
+        self.stop_polling()
+        self._scheduler.cancel()
         self._db = None
         self._records.clear()
         self._tv.delete(*self._tv.get_children(''))
         self.event_generate(MainApp.EVENT_DB_EXIST, state=0)
         self.title(MainApp.TITLE)
 
+    def menu_database_backup(self):
+        if self._backup is not None and self._backup.is_alive():
+            messagebox.showinfo(MainApp.TITLE, 'A backup is still running')
+            return
+        filename = filedialog.asksaveasfilename(defaultextension='.sqlite3')
+        if filename == '':
+            return
+        if filename == self._db.source:
+            messagebox.showerror(MainApp.TITLE, 'Please choose another file')
+            return
+        state = [0.0, None]
+
+        def progress(status, remaining, total):
+            state[0] = 1 - remaining / total if total > 0 else 1.0
+
+        def run(db):
+            state[1] = db.backup(filename, progress=progress, keep=MainApp.BACKUP_KEEP)
+        # 在后台线程中分步复制，不阻塞界面
+        self._backup_state = state
+        self._backup = threading.Thread(target=run, args=(self._db,), daemon=True)
+        self._backup.start()
+        self.after(200, self.watch_backup, self.title())
+
+    def watch_backup(self, title: str):
+        progress, ok = self._backup_state
+        if self._backup.is_alive():
+            self.title('%s (backup %d%%)' % (title, progress * 100))
+            self.after(200, self.watch_backup, title)
+            return
+        self.title(title)
+        if ok:
+            messagebox.showinfo(MainApp.TITLE, 'Backup is done')
+        else:
+            messagebox.showerror(MainApp.TITLE, 'Backup failed')
+
+    def menu_database_import(self):
+        """
+        导入浏览器或其他密码管理器导出的CSV/JSONL文件
+        """
+        option = {'filetypes': [('Exported File', ('*.csv', '*.jsonl')),
+                                ('All Files', ('*.*',))]}
+        filename = filedialog.askopenfilename(**option)
+        if filename == '':
+            return
+        title = self.title()
+
+        def progress(count, inserted):
+            self.title('%s (importing %d/%d entries...)' % (title, inserted, count))
+            self.update_idletasks()
+        try:
+            count, inserted, duplicates, rejected = PassIO.import_file(self._db, filename, progress=progress)
+        except Exception as e:
+            messagebox.showerror(MainApp.TITLE, f'Failed to import: {e}')
+            return
+        finally:
+            self.title(title)
+        self.apply_changes()
+        messagebox.showinfo(MainApp.TITLE, f'{count} entries are read:\n{inserted} imported\n'
+                                           f'{duplicates} already exist\n{rejected} rejected (missing fields)')
+
+    def menu_database_export(self):
+        """
+        导出为CSV、JSONL或otpauth链接列表，扩展名加上.gz则压缩
+        """
+        option = {'filetypes': [('CSV File', ('*.csv', '*.csv.gz')),
+                                ('JSON Lines', ('*.jsonl', '*.jsonl.gz')),
+                                ('OTP URI List', ('*.otpauth.txt', '*.otpauth.txt.gz'))],
+                  'defaultextension': '.csv'}
+        filename = filedialog.asksaveasfilename(**option)
+        if filename == '':
+            return
+        title = self.title()
+
+        def progress(count, last):
+            self.title('%s (exporting %d entries...)' % (title, count))
+            self.update_idletasks()
+        try:
+            count, _ = PassIO.export_file(self._db, filename, progress=progress)
+        except Exception as e:
+            messagebox.showerror(MainApp.TITLE, f'Failed to export: {e}')
+            return
+        finally:
+            self.title(title)
+        messagebox.showinfo(MainApp.TITLE, f'{count} entries are exported.')
+
     def quit_app(self):
         if not messagebox.askokcancel(MainApp.TITLE, 'Are you sure to QUIT?'):
             return
         self.menu_database_close()
+        self._worker.close()
         self.destroy()
 
     def menu_insert_pass(self):
@@ -563,15 +689,17 @@ class MainApp(tk.Tk):
         if any(len(i) == 0 for i in [loc, usr, pwd]):
             messagebox.showerror(MainApp.TITLE, 'Three fields must not be empty!')
             return
-        if any(i.loc == loc and i.usr == usr for i in self._records):
+        if self._db.exists(loc, usr):
             messagebox.showerror(MainApp.TITLE, 'This location already has this credential!')
             return
         new_record = KeychainRecord(loc, usr, pwd)
         dlg = EditRecordDlg(self, title='Insert Record', target=new_record)
         if dlg.show() is False:
             return
-        # 1. update database
-        self._db.insert(new_record)
+        # 1. update database (location and username may be changed in dialog)
+        if not self._db.insert_or_ignore(new_record):
+            messagebox.showerror(MainApp.TITLE, 'This location already has this credential!')
+            return
         # 2. update model
         self._records.append(new_record)
         # 3. UI is updated automatically by variables' change!
@@ -591,12 +719,24 @@ class MainApp(tk.Tk):
         if len(selected) == 0:
             return
         values = self._tv.item(selected, 'values')
-        target: KeychainRecord = self.find_record(sn=int(values[Column.SN]))
+        index = self.find_record_index(sn=int(values[Column.SN]))
+        if index < 0:  # 已经被其他程序删除
+            messagebox.showerror(MainApp.TITLE, 'This record no longer exists!')
+            return
+        current: KeychainRecord = self._records.record(index)
+        # 在副本上编辑，保存失败时模型保持不变
+        target = KeychainRecord(current.loc, current.usr, current.pwd, current.ext, current.sn)
         dlg = EditRecordDlg(self, title='Update Record', target=target)
         if dlg.show() is False:
             return
-        # 1. update database
-        self._db.update(target)
+        # 1. update database and model
+        if (target.loc, target.usr) != (current.loc, current.usr) and self._db.exists(target.loc, target.usr):
+            messagebox.showerror(MainApp.TITLE, 'This location already has this credential!')
+            return
+        if not self._db.update(target):
+            messagebox.showerror(MainApp.TITLE, 'Failed to save the record!')
+            return
+        self._records.replace(index, target)
         # 2. update UI
         otp = OneTimePass.from_json(target.ext)
         extra = '' if otp is None else otp.kind.name
@@ -619,10 +759,71 @@ class MainApp(tk.Tk):
         self._db.delete(record_id)
         # 2. update model
         index = self.find_record_index(sn=record_id)
-        self._records.pop(index)
+        if index >= 0:
+            self._records.remove(index)
         # 3. update UI
         self._tv.delete(selected)
 
+    def menu_reused_pass(self):
+        """
+        列出被多条记录共用的密码
+        """
+        groups = self._db.reused_passwords()
+        if len(groups) == 0:
+            messagebox.showinfo(MainApp.TITLE, 'No password is reused.')
+            return
+        lines = []
+        for ids in groups[:10]:
+            names = []
+            for sn in ids[:3]:
+                index = self._records.find(sn)
+                if index >= 0:
+                    names.append('%s (%s)' % (self._records.loc(index), self._records.usr(index)))
+            more = ' and %d more' % (len(ids) - 3) if len(ids) > 3 else ''
+            lines.append(' / '.join(names) + more)
+        messagebox.showinfo(MainApp.TITLE, '%d passwords are reused:\n%s' % (len(groups), '\n'.join(lines)))
+
+    def menu_breached_pass(self):
+        """
+        用PassBreach.convert()生成的泄露密码库离线检查所有密码
+        """
+        filename = filedialog.askopenfilename(filetypes=[('Breached Hashes', ('*.bin',)), ('All Files', ('*.*',))])
+        if filename == '':
+            return
+        title = self.title()
+
+        def progress(count):
+            self.title('%s (checking %d entries...)' % (title, count))
+            self.update_idletasks()
+        try:
+            with PassBreach.BreachChecker(filename) as checker:
+                breached = PassBreach.check_vault(self._db, checker, progress)
+        except Exception as e:
+            messagebox.showerror(MainApp.TITLE, f'Failed to check: {e}')
+            return
+        finally:
+            self.title(title)
+        if len(breached) == 0:
+            messagebox.showinfo(MainApp.TITLE, 'No password is breached.')
+            return
+        names = []
+        for sn in breached[:10]:
+            index = self._records.find(sn)
+            if index >= 0:
+                names.append('%s (%s)' % (self._records.loc(index), self._records.usr(index)))
+        messagebox.showwarning(MainApp.TITLE, '%d passwords are breached:\n%s' % (len(breached), '\n'.join(names)))
+
+    def menu_help_search_stats(self):
+        """
+        最近几次搜索在后台线程中的耗时
+        """
+        stats = self._scheduler.stats()
+        if stats is None:
+            messagebox.showinfo(MainApp.TITLE, 'No search has been done yet.')
+            return
+        messagebox.showinfo(MainApp.TITLE, 'Last {count} searches (ms):\n'
+                                           'mean {mean:.1f}, p50 {p50:.1f}, p95 {p95:.1f}, max {max:.1f}'.format(**stats))
+
     def menu_help_about(self):
         msg = '''
 Store all credentials together to a local file.
@@ -648,6 +849,48 @@ It's safer than storing them to Web browser.
         else:
             self.restore_from_systray()
 
+    def start_polling(self):
+        self._data_version = self._db.data_version()
+        self._poller = self.after(MainApp.POLL_INTERVAL, self.poll_changes)
+
+    def stop_polling(self):
+        if self._poller is not None:
+            self.after_cancel(self._poller)
+            self._poller = None
+
+    def poll_changes(self):
+        """
+        其他程序修改了数据库时，只把修改的部分应用到self._records
+        """
+        version = self._db.data_version()
+        if version != self._data_version:
+            self._data_version = version
+            self.apply_changes()
+        self._poller = self.after(MainApp.POLL_INTERVAL, self.poll_changes)
+
+    def apply_changes(self):
+        """
+        把修改日志中尚未应用的修改应用到self._records，并刷新查询结果
+        """
+        self._change_seq, changed, deleted = self._db.changes_since(self._change_seq)
+        if changed is None:  # 落后太多，需要的日志已经被清理
+            self.load_records()
+            self.on_input_changed(self._te_loc.text, self._te_usr.text, self._te_pwd.text)
+            return
+        for sn in deleted:
+            index = self._records.find(sn)
+            if index >= 0:
+                self._records.remove(index)
+        for record in changed:
+            index = self._records.find(record.sn)
+            if index >= 0:
+                self._records.replace(index, record)
+            else:
+                self._records.append(record)
+        if len(changed) + len(deleted) > 0:
+            self._db.trim_changes(self._change_seq)
+            self.on_input_changed(self._te_loc.text, self._te_usr.text, self._te_pwd.text)
+
     def refresh_treeview(self, hits):
         self._tv.delete(*self._tv.get_children(''))
         for i, h in enumerate(hits):
@@ -693,7 +936,9 @@ It's safer than storing them to Web browser.
         target = None
         if 'sn' in kw:
             sn = kw.pop('sn')
-            target = next(i for i in self._records if i.sn == sn)
+            index = self._records.find(sn)
+            if index >= 0:
+                target = self._records.record(index)
         return target
 
     def find_record_index(self, **kw) -> int:
@@ -705,11 +950,12 @@ It's safer than storing them to Web browser.
         index = -1
         if 'sn' in kw:
             sn = kw.pop('sn')
-            index = next(i for i, j in enumerate(self._records) if j.sn == sn)
+            index = self._records.find(sn)
         return index
 
     @staticmethod
     def pwd_mask(pwd: str) -> str:
+        pwd = pwd or ''  # 导入的记录可能没有密码（例如只有OTP）
         length = len(pwd)
         if length < 6:
             if pwd.upper() == 'LDAP':
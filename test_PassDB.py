@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+PassDB的事务和数据库升级测试，用法：python -m pytest 或 python -m unittest
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from PassDB import PassDatabase, KeychainRecord, DuplicateEntriesError, RecordStore, ColumnCache
+
+LEGACY_SCHEMA = '''CREATE TABLE keychain (
+                    id  INTEGER PRIMARY KEY UNIQUE NOT NULL,
+                    loc TEXT NOT NULL,
+                    usr TEXT NOT NULL,
+                    pwd TEXT,
+                    ext TEXT)'''
+
+
+def create_legacy(filename: str, rows):
+    """
+    旧版程序创建的数据库：只有keychain表，user_version和application_id都是0
+    """
+    con = sqlite3.connect(filename)
+    con.execute(LEGACY_SCHEMA)
+    con.executemany('INSERT INTO keychain (loc, usr, pwd) VALUES (?,?,?)', rows)
+    con.commit()
+    con.close()
+
+
+def pragma(filename: str, name: str):
+    con = sqlite3.connect(filename)
+    try:
+        return con.execute(f'PRAGMA {name}').fetchone()[0]
+    finally:
+        con.close()
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.db = PassDatabase.create_db(os.path.join(self._folder.name, 'vault.sqlite3'))
+
+    def tearDown(self):
+        self.db.close()
+        self._folder.cleanup()
+
+    def locations(self):
+        return sorted(r.loc for r in self.db.select_all())
+
+    def test_inner_rollback_outer_commit(self):
+        with self.db.transaction():
+            self.db.insert(KeychainRecord('outer', 'u', 'p'))
+            with self.assertRaises(ValueError):
+                with self.db.transaction():
+                    self.db.insert(KeychainRecord('inner', 'u', 'p'))
+                    raise ValueError()
+            self.assertTrue(self.db.in_transaction)
+            self.db.insert(KeychainRecord('after', 'u', 'p'))
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(self.locations(), ['after', 'outer'])
+
+    def test_error_propagates_in_open_scope(self):
+        # 范围内的写操作出错时重新抛出，整个事务回滚
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.db.transaction():
+                self.db.insert(KeychainRecord('a', 'u', 'p'))
+                self.db.insert(KeychainRecord('a', 'u', 'p'))
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(self.locations(), [])
+        # 范围外只打印错误
+        self.assertTrue(self.db.insert_or_ignore(KeychainRecord('a', 'u', 'p')))
+        self.assertFalse(self.db.insert_or_ignore(KeychainRecord('a', 'u', 'p')))
+
+    def test_insert_many_rollback_keeps_records_unsaved(self):
+        records = [KeychainRecord(f'l{i}', 'u', 'p') for i in range(5)] + [KeychainRecord(None, 'u', 'p')]
+        for r in records:
+            r.pwd = 'q'
+        self.assertEqual(self.db.insert_many(records, chunk_size=2), 0)
+        self.assertEqual([r.sn for r in records[:5]], [0] * 5)
+        self.assertTrue(all(r.dirty_mask != 0 for r in records[:5]))
+        self.assertEqual(self.locations(), [])
+
+
+class ChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        filename = os.path.join(self._folder.name, 'vault.sqlite3')
+        PassDatabase.create_db(filename).close()
+        self.a = PassDatabase.open(filename)
+        self.b = PassDatabase.open(filename)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self._folder.cleanup()
+
+    def test_reader_behind_trimmed_log_gets_gap(self):
+        seq_a = seq_b = self.a.last_change()
+        self.a.insert_many(KeychainRecord(f'l{i}', 'u', 'p') for i in range(3000))
+        seq_a, changed, deleted = self.a.changes_since(seq_a)
+        self.assertEqual(len(changed), 3000)
+        self.a.trim_changes(seq_a)
+        last, changed, deleted = self.b.changes_since(seq_b)
+        self.assertEqual(last, 3000)
+        self.assertIsNone(changed)
+        self.assertIsNone(deleted)
+
+    def test_reader_within_retained_log(self):
+        self.a.insert_many(KeychainRecord(f'l{i}', 'u', 'p') for i in range(3000))
+        seq_b = self.b.last_change()
+        self.a.trim_changes(seq_b)
+        self.a.insert(KeychainRecord('new', 'u', 'p'))
+        last, changed, deleted = self.b.changes_since(seq_b)
+        self.assertEqual((last, [r.loc for r in changed], deleted), (3001, ['new'], []))
+
+    def test_last_change_survives_empty_log(self):
+        self.a.insert(KeychainRecord('a', 'u', 'p'))
+        self.a.trim_changes(self.a.last_change(), keep=0)
+        self.assertEqual(self.b.last_change(), 1)
+        self.assertEqual(self.b.changes_since(1), (1, [], []))
+
+
+class RecordStoreTest(unittest.TestCase):
+    def test_find_skips_removed_record_with_reused_id(self):
+        store = RecordStore()
+        store.extend(KeychainRecord(f'l{i}', 'u', 'p', sn=i) for i in (1, 2, 3))
+        store.remove(store.find(3))
+        self.assertEqual(store.find(3), -1)
+        # 删除id最大的记录后SQLite重用它的id
+        index = store.append(KeychainRecord('again', 'u', 'p', sn=3))
+        self.assertEqual(store.find(3), index)
+        self.assertEqual(store.loc(store.find(3)), 'again')
+        self.assertEqual(store.find(2), 1)
+        self.assertEqual(len(store), 3)
+
+    def test_find_in_sorted_store(self):
+        store = RecordStore()
+        store.extend(KeychainRecord(f'l{i}', 'u', 'p', sn=i) for i in (1, 5, 9))
+        self.assertEqual([store.find(sn) for sn in (0, 1, 5, 7, 9, 10)], [-1, 0, 1, -1, 2, -1])
+
+
+class ColumnCacheTest(unittest.TestCase):
+    def test_value_read_before_discard_is_not_cached(self):
+        values = {1: ('old', None)}
+
+        def fetch(sn):
+            value = values[sn]
+            # 读取之后、缓存之前，写线程提交了修改
+            values[sn] = ('new', None)
+            cache.discard(sn)
+            return value
+
+        cache = ColumnCache(fetch)
+        self.assertEqual(cache.get(1), ('old', None))
+        cache._fetch = values.get
+        self.assertEqual(cache.get(1), ('new', None))
+
+    def test_failure_is_not_cached(self):
+        values = {}
+        cache = ColumnCache(values.get)
+        self.assertEqual(cache.get(1), (None, None))
+        values[1] = ('p', None)
+        self.assertEqual(cache.get(1), ('p', None))
+
+    def test_lazy_record_sees_update_from_other_connection(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'vault.sqlite3')
+            a = PassDatabase.create_db(filename)
+            b = PassDatabase.open(filename)
+            try:
+                record = KeychainRecord('l', 'u', 'old')
+                a.insert(record)
+                self.assertEqual(b.column_cache.get(record.sn), ('old', None))
+                record.pwd = 'new'
+                a.update(record)
+                b.changes_since(0)  # 应用修改日志时清除缓存
+                self.assertEqual(b.column_cache.get(record.sn), ('new', None))
+            finally:
+                a.close()
+                b.close()
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self._folder.name, 'legacy.sqlite3')
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def test_legacy_vault_to_latest(self):
+        create_legacy(self.filename, [('https://github.com', 'me', 'p1'), ('https://gitlab.com', 'me', 'p1')])
+        db = PassDatabase.open(self.filename)
+        self.assertIsNotNone(db)
+        try:
+            self.assertEqual(db.schema_version, PassDatabase.SCHEMA_VERSION)
+            self.assertEqual(pragma(self.filename, 'application_id'), PassDatabase.APPLICATION_ID)
+            self.assertEqual([r.loc for r in db.search(loc='github')], ['https://github.com'])  # 版本1：全文索引
+            self.assertFalse(db.insert_or_ignore(KeychainRecord('https://github.com', 'me', 'x')))  # 版本2：唯一索引
+            self.assertEqual(db.last_change(), 0)  # 版本3：修改日志，升级本身不记日志
+            self.assertEqual(db.reused_passwords(), [[1, 2]])  # 版本4：密码哈希
+        finally:
+            db.close()
+        # 已经是最新版本的数据库再次打开时不再升级
+        db = PassDatabase.open(self.filename)
+        self.assertEqual(db.schema_version, PassDatabase.SCHEMA_VERSION)
+        db.close()
+
+    def test_vault_with_duplicates(self):
+        create_legacy(self.filename, [('a', 'u', '1'), ('a', 'u', '2'), ('b', 'u', '3')])
+        with self.assertRaises(DuplicateEntriesError):
+            PassDatabase.open(self.filename)
+        self.assertEqual(pragma(self.filename, 'user_version'), 1)  # 唯一索引没有建立，不记录版本2
+        con = sqlite3.connect(self.filename)
+        con.execute('DELETE FROM keychain WHERE id=2')
+        con.commit()
+        con.close()
+        db = PassDatabase.open(self.filename)
+        self.assertEqual(db.schema_version, PassDatabase.SCHEMA_VERSION)
+        self.assertTrue(db.insert_or_ignore(KeychainRecord('c', 'u', '4')))
+        db.close()
+
+    def test_foreign_database_is_not_modified(self):
+        con = sqlite3.connect(self.filename)
+        con.execute('CREATE TABLE other (x)')
+        con.commit()
+        con.close()
+        self.assertIsNone(PassDatabase.open(self.filename))
+        self.assertEqual(pragma(self.filename, 'journal_mode'), 'delete')
+
+
+if __name__ == '__main__':
+    unittest.main()